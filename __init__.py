@@ -13,23 +13,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import anki.collection  # isort:skip # noqa: F401
-from anki.notes import Note
-from aqt import gui_hooks, mw
+# Only hooks are registered at startup. Sync modules, bs4 and templates are loaded on first use,
+# the import of this module must stay within STARTUP_BUDGET (checked by test_startup.py).
+# Outside of Anki, e.g. for cli.py on a server without GUI libraries, nothing is registered.
 
-from . import bidir, unidir
+import sys
 
+STARTUP_BUDGET = 0.02
 
-def on_editor_did_unfocus_field(changed: bool, note: Note, field_idx: int) -> bool:
-    # return True if changes were made, otherwise return changed
-    changed |= unidir.sync_field(mw.col, note, field_idx)
-    changed |= bidir.sync_field(mw.col, note, field_idx)
-    return changed
-
-
-def on_sync_will_start():
-    unidir.sync_all()
-
-
-gui_hooks.editor_did_unfocus_field.append(on_editor_did_unfocus_field)
-gui_hooks.sync_will_start.append(on_sync_will_start)
+# Anki imports aqt before it loads add-ons
+if 'aqt' in sys.modules:
+    from . import gui  # noqa: F401
@@ -0,0 +1,212 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Benchmarks on synthetic collections. Run from the folder containing the add-on:
+
+    python -m <add-on folder>.bench --notes 10000 100000 --density 0.5 --fanout 10
+
+Every case appends a JSON line to the output file.
+'''
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+from typing import Callable, Iterable
+
+from anki.collection import AddNoteRequest
+
+from . import bidir, spans, unidir
+from .bidir import BidirIndex
+from .index import NoteIndex
+from .test_utils import get_empty_col
+
+OUTPUT = os.path.join(os.path.dirname(__file__), 'bench_output.txt')
+# Custom note types of test_utils used as sources
+SOURCE_TYPES = ('EQ', 'IM', 'IM (reversed)')
+
+
+class Synthetic():
+    '''
+    Collection with `notes` notes. A `density` fraction of them shows a source note in its front and
+    shares a bidirectional span in its back. Every source and sid is shown by about `fanout` notes.
+    '''
+
+    def __init__(self, notes: int, density: float, fanout: int, seed: int = 0):
+        self.rng = random.Random(seed)
+        self.col = get_empty_col()
+        self.templates = tempfile.mkdtemp()
+        self.sources: list[int] = []
+        self.referencing: list[int] = []
+        self.sids: list[str] = []
+
+        n_referencing = int(notes * density)
+        n_sources = max(1, n_referencing // fanout)
+        n_plain = max(0, notes - n_referencing - n_sources)
+
+        requests = []
+        for i in range(n_sources):
+            model = self.col.models.by_name(SOURCE_TYPES[i % len(SOURCE_TYPES)])
+            note = self.col.new_note(model)
+            for j, name in enumerate(note.keys()):
+                note[name] = f'{{{{c{j + 1}::{name} {i}}}}} text' if name.startswith('Cloze') else f'{name} {i}'
+            requests.append(AddNoteRequest(note, 1))
+        self.__add(requests, self.sources)
+
+        basic = self.col.models.by_name('Basic')
+        self.sids = [f'1_1_{i:04}' for i in range(max(1, n_referencing // fanout))]
+        requests = []
+        for i in range(n_referencing):
+            note = self.col.new_note(basic)
+            note['Front'] = f'Front {i} <span class="sync" note="{self.rng.choice(self.sources)}"></span>'
+            note['Back'] = f'<b>Back {i}</b> <span class="sync" sid="{self.rng.choice(self.sids)}">Shared</span>'
+            requests.append(AddNoteRequest(note, 1))
+        self.__add(requests, self.referencing)
+
+        requests = []
+        for i in range(n_plain):
+            note = self.col.new_note(basic)
+            note['Front'] = f'Plain {i}'
+            requests.append(AddNoteRequest(note, 1))
+        self.__add(requests, [])
+
+        for name in SOURCE_TYPES:
+            model = self.col.models.by_name(name)
+            fields = ''.join('{{' + field['name'] + (':cloze' if field['name'].startswith('Cloze') else '') + '}}'
+                             for field in model['flds'])
+            with open(os.path.join(self.templates, f'{name}.html'), 'w') as f:
+                f.write(f'<div>{fields}</div>')
+
+        # Pretend the collection was created long ago, notes modified right now are rescanned by indexes
+        self.col.db.execute('update notes set mod = mod - 3600')
+
+    def __add(self, requests: list[AddNoteRequest], nids: list[int]):
+        self.col.add_notes(requests)
+        nids.extend(request.note.id for request in requests)
+
+    def sample(self, items: list, n: int) -> list:
+        return self.rng.sample(items, min(n, len(items)))
+
+    def close(self):
+        self.col.close(downgrade=False)
+
+
+def timed(name: str, run: Callable[[], object], ops: int = 1) -> dict:
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    return {'case': name, 'ops': ops, 'seconds': seconds, 'per_op': seconds / ops if ops > 0 else None}
+
+
+def each(items: Iterable, run: Callable[[object], object]) -> Callable[[], None]:
+    def run_all():
+        for item in items:
+            run(item)
+    return run_all
+
+
+def cases(syn: Synthetic, sample: int) -> Iterable[dict]:
+    col = syn.col
+    fields = [(col.get_note(nid), 0) for nid in syn.sample(syn.referencing, sample)]
+    yield timed('unidir.sync_field', each(fields, lambda field: unidir.sync_field(col, *field)), len(fields))
+
+    unidir.render_cache.clear()
+    yield timed('unidir.sync_all (cold)', lambda: unidir.sync_all(col), len(syn.referencing))
+    yield timed('unidir.sync_all (unchanged)', lambda: unidir.sync_all(col), len(syn.referencing))
+
+    source = col.get_note(syn.rng.choice(syn.sources))
+    source[source.keys()[-1]] += ' changed'
+    col.update_note(source)
+    yield timed('unidir.sync_all (one source changed)', lambda: unidir.sync_all(col), 1)
+
+    index = BidirIndex.get(col)
+    yield timed('bidir.index (cold)', lambda: index.refresh(col), len(syn.referencing))
+
+    def coherent(sid: str):
+        bidir.are_spans_coherent(col, index.nids(sid), sid)
+
+    def download(sid: str):
+        bidir.download(col, index.nids(sid)[0], sid)
+
+    def upload(sid: str):
+        span = spans.parse(f'<span class="sync" sid="{sid}">Uploaded {sid}</span>').spans[0]
+        bidir.upload(col, index.nids(sid), span)
+
+    sids = syn.sample(syn.sids, sample)
+    yield timed('bidir.are_spans_coherent', each(sids, coherent), len(sids))
+    yield timed('bidir.download', each(sids, download), len(sids))
+    yield timed('bidir.upload', each(sids, upload), len(sids))
+
+    notes = [col.get_note(nid) for nid in syn.sample(syn.referencing, sample)]
+    yield timed('bidir.generate_sid', each(notes, lambda note: bidir.generate_sid(col, note, 1)), len(notes))
+
+
+def revision() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__) or '.',
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(notes: int, density: float, fanout: int, seed: int = 0, sample: int = 200,
+        backend: str = spans.backend) -> list[dict]:
+    meta = {
+        'notes': notes, 'density': density, 'fanout': fanout, 'seed': seed, 'backend': backend,
+        'revision': revision(), 'python': platform.python_version(), 'time': int(time.time()),
+    }
+    previous = (spans.backend, unidir.Fetcher.templates)
+    results = []
+    start = time.perf_counter()
+    syn = Synthetic(notes, density, fanout, seed)
+    results.append(dict(meta, case='build', ops=notes, seconds=time.perf_counter() - start, per_op=None))
+    try:
+        spans.backend = backend
+        unidir.Fetcher.templates = unidir.TemplateRegistry(syn.templates)
+        for result in cases(syn, sample):
+            results.append(dict(meta, **result))
+    finally:
+        spans.backend, unidir.Fetcher.templates = previous
+        NoteIndex._cache.clear()
+        syn.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Notesync benchmarks on synthetic collections')
+    parser.add_argument('--notes', type=int, nargs='+', default=[10000])
+    parser.add_argument('--density', type=float, default=0.5, help='fraction of notes with sync spans')
+    parser.add_argument('--fanout', type=int, default=10, help='notes showing each source and sid')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sample', type=int, default=200, help='calls of the per note cases')
+    parser.add_argument('--backend', choices=sorted(spans.BACKENDS), default=spans.backend)
+    parser.add_argument('--output', default=OUTPUT)
+    args = parser.parse_args()
+
+    with open(args.output, 'a') as f:
+        for notes in args.notes:
+            for result in run(notes, args.density, args.fanout, args.seed, args.sample, args.backend):
+                f.write(json.dumps(result) + '\n')
+                f.flush()
+                print(f'{notes:>8} {result["case"]:<40} {result["seconds"]:10.3f} s')
+
+
+if __name__ == '__main__':
+    main()
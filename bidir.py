@@ -13,124 +13,459 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import warnings
-from copy import copy
 from random import randrange
-from typing import Callable, Sequence
+from typing import Callable, Iterable, Sequence
 
-from anki.collection import Collection
+from anki.collection import Collection, OpChangesWithCount
 from anki.notes import Note, NoteId
-from aqt.utils import askUserDialog
-from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
 
-warnings.filterwarnings('ignore', category=MarkupResemblesLocatorWarning, module='bs4')
+from .documents import Documents, content_hash
+from .index import NoteIndex
+from .instrument import phase
+from .spans import Document, Span, has_sync_spans, parse
 
-Popup = Callable[[str], str]
+UNDO_RECONCILE = 'Notesync: Reconcile'
+# How sids with differing spans are handled by a collection-wide pass
+POLICIES = ('newest', 'prompt', 'report')
+
+# Answers Upload or Download, None leaves the spans as they are
+Popup = Callable[[str], str | None]
+# Pick one of the distinct versions of a sid (newest first) to upload everywhere, None leaves them as they are
+Choose = Callable[[str, list[Span]], Span | None]
 
 
 def default_popup(sid: str) -> str:
+    from aqt.utils import askUserDialog
     return askUserDialog(f'Span with sid {sid} has changed.', ('Upload', 'Download')).run()
 
 
+def span_hash(span: Span) -> str:
+    return content_hash(span.inner)
+
+
+# Hash of a span referencing the content without a copy of it
+EMPTY_HASH = content_hash('')
+
+
+class BidirIndex(NoteIndex):
+    '''
+    Index from a sid to the notes and fields containing it, with content hashes and offsets of the spans.
+    The last content all notes agreed on is kept as the base of a three-way merge.
+    '''
+    NAME = 'bidir'
+    VERSION = 5
+    SID_SUFFIXES = 10000
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        # sid -> nid -> field indices
+        self.sids: dict[str, dict[int, set[int]]] = {}
+        # Sids handed out, but possibly not saved in a note yet
+        self.allocated: set[str] = set()
+        # sid -> hash of the last content shared by all its non-empty spans
+        self.bases: dict[str, str] = {}
+        # Sids of rescanned fields, their bases are updated after the refresh
+        self.touched: set[str] = set()
+
+    def dump(self) -> dict:
+        return {'bases': self.bases}
+
+    def restore(self, data: dict):
+        self.bases = data['bases']
+
+    def scan_field(self, field: str) -> dict[str, list[list]] | None:
+        # sid -> [hash, start, end] of each span
+        spans = {}
+        for span in parse(field).find(sid=True):
+            spans.setdefault(span.get('sid'), []).append([span_hash(span), span.start, span.end])
+        return spans if len(spans) > 0 else None
+
+    def link(self, nid: int, field_idx: int, spans: dict[str, list[list]]):
+        self.touched.update(spans)
+        for sid in spans:
+            self.sids.setdefault(sid, {}).setdefault(nid, set()).add(field_idx)
+
+    def unlink(self, nid: int, field_idx: int, spans: dict[str, list[list]]):
+        self.touched.update(spans)
+        for sid in spans:
+            locations = self.sids.get(sid)
+            if locations is None or nid not in locations:
+                continue
+            locations[nid].discard(field_idx)
+            if len(locations[nid]) == 0:
+                del locations[nid]
+            if len(locations) == 0:
+                del self.sids[sid]
+
+    def refreshed(self):
+        for sid in self.touched:
+            if sid not in self.sids:
+                self.bases.pop(sid, None)
+                continue
+            hashes = self.hashes(sid, self.sids[sid]) - {EMPTY_HASH}
+            if len(hashes) == 1:
+                self.bases[sid] = hashes.pop()
+        self.touched.clear()
+
+    def allocate(self, prefix: str, n: int) -> list[str]:
+        '''
+        Return n unused sids with the given prefix.
+        '''
+        # Random start lowers the chance of a clash with sids created on another device
+        suffix = randrange(0, self.SID_SUFFIXES)
+        sids = []
+        for _ in range(self.SID_SUFFIXES):
+            sid = f'{prefix}{suffix:04}'
+            if sid not in self.sids and sid not in self.allocated:
+                self.allocated.add(sid)
+                sids.append(sid)
+                if len(sids) == n:
+                    return sids
+            suffix = (suffix + 1) % self.SID_SUFFIXES
+        raise ValueError('No free sid')
+
+    def nids(self, sid: str) -> list[NoteId]:
+        return [NoteId(nid) for nid in self.sids.get(sid, {})]
+
+    def fields(self, sid: str, nid: int) -> set[int]:
+        return self.sids.get(sid, {}).get(nid, set())
+
+    def hashes(self, sid: str, nids: Iterable[int]) -> set[str]:
+        hashes = set()
+        for nid in nids:
+            for field_idx in self.fields(sid, nid):
+                hashes.update(digest for digest, _, _ in self.notes[nid][field_idx][sid])
+        return hashes
+
+
+def _index(col: Collection, index: BidirIndex | None) -> BidirIndex:
+    '''
+    Return the given index, refreshed by the caller already, or refresh the index of the collection.
+    '''
+    if index is None:
+        index = BidirIndex.get(col)
+        index.refresh(col)
+    return index
+
+
+def generate_sids(col: Collection, note: Note, field_idx: int, n: int, index: BidirIndex | None = None) -> list[str]:
+    index = _index(col, index)
+    return index.allocate(f'{note.id}_{field_idx}_', n)
+
+
 def generate_sid(col: Collection, note: Note, field_idx: int) -> str:
-    def generate_sid_internal():
-        return f'{note.id}_{field_idx}_{randrange(0, 10000):04}'
-    sid = generate_sid_internal()
-    while len(col.find_notes(f'sid="{sid}"')) > 0:
-        sid = generate_sid_internal()
-    return sid
+    return generate_sids(col, note, field_idx, 1)[0]
+
+
+def three_way(base: str | None, this: str, others: set[str]) -> str | None:
+    '''
+    Answer Upload or Download when only one side changed since the base, None on concurrent changes.
+    '''
+    others = others - {EMPTY_HASH}
+    if len(others) == 0:
+        return 'Upload'  # the other spans only reference the content
+    if base is None:
+        return None
+    if others == {base}:
+        return 'Upload'
+    if this == base and len(others) == 1:
+        return 'Download'
+    return None
 
 
-def are_spans_coherent(col: Collection, nids: Sequence[NoteId], sid: int) -> bool:
+def merge(base: str | None, spans: list[Span]) -> Span | None:
+    '''
+    Return the only version which differs from the base, None if there are several.
+    '''
+    if len(spans) == 1:
+        return spans[0]
+    changed = [span for span in spans if span_hash(span) != base]
+    return changed[0] if len(changed) == 1 else None
+
+
+def are_spans_coherent(col: Collection, nids: Sequence[NoteId], sid: int, index: BidirIndex | None = None) -> bool:
     if len(nids) <= 1:
         return True
 
-    span_str = None
-    for nid in nids:
-        note = col.get_note(nid)
-        for field_val in note.values():
-            bs = BeautifulSoup(field_val, 'html.parser')
-            spans = bs.find_all('span', {'class': 'sync', 'sid': sid}, recursive=False)
-            for span in spans:
-                if span_str is None:
-                    span_str = span.string if span.string is not None else ''
-                elif span_str != span.string:
-                    return False
-    return True
+    with phase('bidir.coherent', sid):
+        index = _index(col, index)
+        return len(index.hashes(str(sid), nids)) <= 1
+
+
+def incoherent(col: Collection) -> dict[str, list[NoteId]]:
+    '''
+    Return sids whose spans differ, with the notes containing them, from a single refresh of the index.
+    '''
+    with phase('bidir.incoherent'):
+        index = BidirIndex.get(col)
+        index.refresh(col)
+        return {sid: index.nids(sid) for sid, locations in index.sids.items()
+                if len(index.hashes(sid, locations)) > 1}
 
 
-def upload(col: Collection, nids: Sequence[NoteId], span: BeautifulSoup):
+def versions(col: Collection, sid: str, nids: Sequence[NoteId], docs: Documents) -> list[Span]:
+    '''
+    Return spans with distinct content of the sid, from the most recently modified note first.
+    Empty spans only reference the content, they are left out unless all spans are empty.
+    '''
+    index = BidirIndex.get(col)
+    docs.preload(col, nids)
+    notes = sorted((docs.note(col, nid) for nid in nids), key=lambda note: note.mod, reverse=True)
+    spans: dict[str, Span] = {}
+    for note in notes:
+        for field_idx in sorted(index.fields(sid, note.id)):
+            for span in docs.get(note, field_idx).find(sid=sid):
+                spans.setdefault(span.inner, span)
+    if len(spans) > 1:
+        spans.pop('', None)
+    return list(spans.values())
+
+
+def conflicts(col: Collection, sids: Iterable[str] | None = None,
+              docs: Documents | None = None) -> dict[str, list[Span]]:
+    '''
+    Return the distinct versions of sids (all by default) which cannot be merged automatically.
+    '''
+    if docs is None:
+        docs = Documents()
+    groups = incoherent(col)
+    index = BidirIndex.get(col)
+    out = {}
+    for sid in groups if sids is None else sids:
+        if sid not in groups:
+            continue
+        spans = versions(col, sid, groups[sid], docs)
+        if merge(index.bases.get(sid), spans) is None:
+            out[sid] = spans
+    return out
+
+
+class ConflictQueue():
+    '''
+    Popup which answers nothing and records the sid, so that conflicts are resolved later in one batch.
+    '''
+
+    def __init__(self):
+        # Ordered set of sids
+        self.sids: dict[str, None] = {}
+
+    def __call__(self, sid: str) -> str | None:
+        self.sids[sid] = None
+        return None
+
+    def __len__(self) -> int:
+        return len(self.sids)
+
+    def take(self, col: Collection) -> dict[str, list[Span]]:
+        '''
+        Empty the queue, return versions of the sids which still differ.
+        '''
+        sids, self.sids = self.sids, {}
+        return conflicts(col, sids)
+
+
+def newest(sid: str, spans: list[Span]) -> Span | None:
+    return spans[0]
+
+
+def skip(sid: str, spans: list[Span]) -> Span | None:
+    return None
+
+
+def sync_all_op(col: Collection, choose: Choose = newest) -> OpChangesWithCount:
+    '''
+    Reconcile all sids whose spans differ, found by a single refresh of the index.
+    Choose is asked once per sid unless a single version changed since the base. Notes are saved at once.
+    '''
+    docs = Documents()
+    index = BidirIndex.get(col)
+    with phase('bidir.sync_all'):
+        # Notes are saved at the end, the index refreshed by incoherent stays valid for all uploads
+        for sid, nids in incoherent(col).items():
+            spans = versions(col, sid, nids, docs)
+            span = merge(index.bases.get(sid), spans)
+            if span is None:
+                span = choose(sid, spans)
+            if span is not None:
+                upload(col, nids, span, docs, index)
+
+    return _flush_op(col, docs)
+
+
+def resolve_op(col: Collection, chosen: dict[str, Span], seen: dict[str, set[str]] | None = None,
+               queue: ConflictQueue | None = None) -> OpChangesWithCount:
+    '''
+    Upload the chosen span of each sid to all notes containing it. Notes are saved at once.
+    Sids whose content hashes differ from the seen ones were edited after the versions were listed,
+    they are skipped and added to the queue.
+    '''
+    docs = Documents()
+    index = BidirIndex.get(col)
+    index.refresh(col)
+    with phase('bidir.resolve'):
+        for sid, span in chosen.items():
+            nids = index.nids(sid)
+            if seen is not None and index.hashes(sid, nids) - {EMPTY_HASH} != seen.get(sid):
+                if queue is not None:
+                    queue(sid)
+                continue
+            upload(col, nids, span, docs, index)
+    return _flush_op(col, docs)
+
+
+def _flush_op(col: Collection, docs: Documents) -> OpChangesWithCount:
+    out = OpChangesWithCount()
+    if len(docs.changed) > 0 or len(docs.updated) > 0:
+        undo_entry = col.add_custom_undo_entry(UNDO_RECONCILE)
+        out.count = len(docs.flush(col))
+        out.changes.CopyFrom(col.merge_undo_entries(undo_entry))
+    BidirIndex.get(col).save()
+    return out
+
+
+def sync_all(col: Collection, choose: Choose = newest) -> int:
+    return sync_all_op(col, choose).count
+
+
+def upload(col: Collection, nids: Sequence[NoteId], span: Span, docs: Documents | None = None,
+           index: BidirIndex | None = None):
     '''
     Upload a span to all given notes. Span must have a sid attribute.
     '''
+    if docs is None:
+        docs = Documents()
+        upload(col, nids, span, docs, index)
+        docs.flush(col)
+        return
+
     sid = span.get('sid')
-    for nid in nids:
-        note = col.get_note(nid)
-        for field_key, field_val in note.items():
-            bs = BeautifulSoup(field_val, 'html.parser')
-            spans = bs.find_all('span', {'class': 'sync', 'sid': sid}, recursive=False)
-            if len(spans) == 0:
+    with phase('bidir.upload', sid):
+        _upload(col, nids, span, sid, docs, _index(col, index))
+
+
+def splice(text: str, sid: str, located: list[list], html: str) -> str | None:
+    '''
+    Replace the spans of the sid at the offsets located by the index, without parsing the rest of the text.
+    Return None if the text no longer matches the index.
+    '''
+    for digest, start, end in sorted(located, key=lambda loc: loc[1], reverse=True):
+        old = text[start:end]
+        spans = Document(old).spans
+        if len(spans) != 1 or spans[0].html != old or spans[0].get('sid') != sid or span_hash(spans[0]) != digest:
+            return None
+        if old != html:
+            text = text[:start] + html + text[end:]
+    return text
+
+
+def _upload(col: Collection, nids: Sequence[NoteId], span: Span, sid: str, docs: Documents, index: BidirIndex):
+    digest = span_hash(span)
+    # The content is agreed on, even before the notes are saved and rescanned
+    index.bases[sid] = digest
+    # Fields whose spans already have the same content are neither parsed nor saved
+    todo = [(nid, field_idx) for nid in nids for field_idx in index.fields(sid, nid)
+            if (nid, field_idx) in docs.changed or index.hashes(sid, [nid]) != {digest}]
+    docs.preload(col, {nid for nid, _ in todo})
+    for nid, field_idx in todo:
+        note = docs.note(col, nid)
+        # Offsets are stale once the field was changed by this operation
+        if (nid, field_idx) not in docs.changed and nid not in docs.updated:
+            text = splice(note.fields[field_idx], sid, index.notes[nid][field_idx][sid], span.html)
+            if text is not None:
+                docs.update(note, field_idx, text)
                 continue
-            for other_span in spans:
-                other_span.replace_with(copy(span))
-            note[field_key] = bs.encode(formatter='html5').decode('utf-8')
-        col.update_note(note)
+        doc = docs.get(note, field_idx)
+        changed = False
+        for other_span in doc.find(sid=sid):
+            if other_span.inner != span.inner:
+                doc.replace(other_span, span.html)
+                changed = True
+        if changed:
+            docs.mark_changed(note, field_idx)
 
 
-def download(col: Collection, nid: NoteId, sid: int):
+def download(col: Collection, nid: NoteId, sid: int, docs: Documents | None = None) -> Span | None:
     '''
-    Return value of random span with the sid given notes to search in.
+    Return a span with the sid from the note, preferring one with content over an empty reference.
     '''
-    note = col.get_note(nid)
-    for field_val in note.values():
-        bs = BeautifulSoup(field_val, 'html.parser')
-        spans = bs.find_all('span', {'class': 'sync', 'sid': sid}, recursive=False)
-        if len(spans) > 0:
-            return spans[0]
-    return None
+    if docs is None:
+        docs = Documents()
+    found = None
+    with phase('bidir.download', sid):
+        index = BidirIndex.get(col)
+        note = docs.note(col, nid)
+        for field_idx in index.fields(str(sid), nid):
+            for span in docs.get(note, field_idx).find(sid=str(sid)):
+                if span.inner != '':
+                    return span
+                if found is None:
+                    found = span
+    return found
 
 
-def sync_field(col: Collection, this_note: Note, field_idx: int,
-               popup: Popup = default_popup) -> bool:
+def sync_field(col: Collection, this_note: Note, field_idx: int, popup: Popup = default_popup,
+               docs: Documents | None = None, only: Callable[[Span], bool] | None = None) -> bool:
+    '''
+    Give sids to new spans and reconcile the rest with their copies in other notes.
+    Spans with a sid are skipped unless only is None or returns True for them.
+    '''
     if this_note.id == 0:
         return False  # the card is being created
     if field_idx < 0 or field_idx >= len(this_note.values()):
         return False  # should not happen
+    if not has_sync_spans(this_note.fields[field_idx]):
+        return False
+    if docs is None:
+        docs = Documents()
+        changed = sync_field(col, this_note, field_idx, popup, docs, only)
+        docs.flush(col)
+        return changed
 
     changed = False
-    bs = BeautifulSoup(this_note.values()[field_idx], 'html.parser')
-
-    # recursive=False: transitive references are not propagated (only top spans are synced)
-    spans = bs.find_all('span', {'class': 'sync', 'note': False}, recursive=False)
-    for span in spans:
-        if not span.has_attr('sid'):
-            sid = generate_sid(col, this_note, field_idx)
-            span['sid'] = sid
-            changed = True
-            continue
+    doc = docs.get(this_note, field_idx)
 
-        sid = span['sid']
-        nids = col.find_notes(f'<span class=\\"sync\\" sid=\\"{sid}\\">')
-        if are_spans_coherent(col, nids, sid):
+    # top-level spans only: transitive references are not propagated
+    new_spans = doc.find(note=False, sid=False)
+    old_spans = [span for span in doc.find(note=False, sid=True) if only is None or only(span)]
+    if len(new_spans) == 0 and len(old_spans) == 0:
+        return False
+    index = BidirIndex.get(col)
+    index.refresh(col)
+
+    if len(new_spans) > 0:
+        for span, sid in zip(new_spans, generate_sids(col, this_note, field_idx, len(new_spans), index)):
+            doc.set_attr(span, 'sid', sid)
+        changed = True
+
+    for span in old_spans:
+        sid = span.get('sid')
+        nids = [nid for nid in index.nids(sid) if nid != this_note.id]
+        if len(nids) == 0 or index.hashes(sid, nids) == {span_hash(span)}:
             continue
 
-        if span.string is None:
+        if span.inner == '':
             answer = 'Download'
         else:
-            answer = popup(sid)
-
-        if this_note.id in nids:
-            nids.remove(this_note.id)
+            answer = three_way(index.bases.get(sid), span_hash(span), index.hashes(sid, nids))
+            if answer is None:
+                answer = popup(sid)
 
+        if answer is None:
+            continue
         if answer == 'Upload':
-            upload(col, nids, span)
+            upload(col, nids, span, docs, index)
         else:
-            # Idx 0 will always exist. If len(nids) == 1, spans are always coherent
-            span.replace_with(download(col, nids[0], sid))
+            # Empty spans only reference the content, download from a note holding it
+            source = next((nid for nid in nids if len(index.hashes(sid, [nid]) - {EMPTY_HASH}) > 0), nids[0])
+            other_span = download(col, source, sid, docs)
+            if other_span is None:
+                continue  # stale index
+            doc.replace(span, other_span.html)
+            if other_span.inner != '':
+                index.bases[sid] = span_hash(other_span)
 
         changed = True
 
     if changed:
-        this_note.values()[field_idx] = bs.encode(formatter='html5').decode('utf-8')
-        col.update_note(this_note)
+        docs.mark_changed(this_note, field_idx)
     return changed
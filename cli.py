@@ -0,0 +1,115 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+'''
+Headless sync of a collection file which is not open in Anki. Run from the folder containing the add-on:
+
+    python -m <add-on folder>.cli path/to/collection.anki2 --timings
+
+Spans referencing other notes are re-rendered and saved. Bidirectional spans which differ are reconciled
+by --policy, those left different are reported.
+'''
+
+import argparse
+import sys
+import time
+
+from anki.collection import Collection
+from anki.utils import strip_html
+
+from . import bidir, instrument, unidir
+from .index import NoteIndex
+from .spans import Span
+
+
+class Report():
+    def __init__(self):
+        self.updated = 0
+        self.reconciled = 0
+        # sid -> notes containing it
+        self.incoherent: dict[str, list[int]] = {}
+        # step -> seconds
+        self.seconds: dict[str, float] = {}
+
+    def summary(self) -> str:
+        lines = [f'{self.updated} notes updated', f'{self.reconciled} notes reconciled',
+                 f'{len(self.incoherent)} incoherent sids']
+        lines.extend(f'  {sid}: {" ".join(map(str, nids))}' for sid, nids in sorted(self.incoherent.items()))
+        lines.extend(f'{step:<10} {seconds:10.3f} s' for step, seconds in self.seconds.items())
+        return '\n'.join(lines)
+
+
+def sync(col: Collection, progress: unidir.Progress | None = None, choose: bidir.Choose = bidir.skip) -> Report:
+    '''
+    Refresh unidirectional spans of the whole collection and reconcile bidirectional ones.
+    '''
+    report = Report()
+
+    # Bidirectional first: rendered notes would look like the most recent ones, and sources may contain the spans
+    start = time.perf_counter()
+    report.reconciled = bidir.sync_all_op(col, choose).count
+    report.incoherent = bidir.incoherent(col)
+    report.seconds['bidir'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    report.updated = unidir.sync_all_op(col, progress).count
+    report.seconds['unidir'] = time.perf_counter() - start
+    return report
+
+
+def prompt_version(sid: str, spans: list[Span]) -> Span | None:
+    print(f'Spans with sid {sid} differ:', file=sys.stderr)
+    for i, span in enumerate(spans, 1):
+        print(f'  {i}: {strip_html(span.inner)[:80]}', file=sys.stderr)
+    answer = input('Version to keep (empty to leave them as they are): ')
+    if answer.isdigit() and 1 <= int(answer) <= len(spans):
+        return spans[int(answer) - 1]
+    return None
+
+
+def print_progress(done: int, total: int) -> bool:
+    print(f'\rRendering {done}/{total}', end='', file=sys.stderr, flush=True)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Notesync batch sync of a collection file')
+    parser.add_argument('collection', help='path to a .anki2 file, Anki must not have it open')
+    parser.add_argument('--policy', choices=bidir.POLICIES, default='report',
+                        help='how bidirectional spans which differ are reconciled')
+    parser.add_argument('--timings', action='store_true', help='print durations of the sync phases')
+    parser.add_argument('--quiet', action='store_true', help='no progress output')
+    args = parser.parse_args()
+
+    instrument.enabled = args.timings
+    col = Collection(args.collection)
+    try:
+        choose = {'newest': bidir.newest, 'prompt': prompt_version, 'report': bidir.skip}[args.policy]
+        report = sync(col, None if args.quiet else print_progress, choose)
+        NoteIndex.save_all()
+    finally:
+        col.close(downgrade=False)
+    if not args.quiet:
+        print(file=sys.stderr)
+
+    print(report.summary())
+    if args.timings:
+        print()
+        print(instrument.stats.summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+from anki.collection import Collection
+
+
+@pytest.fixture
+def updated(col: Collection, monkeypatch) -> list[list[int]]:
+    '''
+    Sorted ids of the notes saved by each call of col.update_notes.
+    '''
+    calls = []
+    update_notes = col.update_notes
+
+    def update(notes, **kwargs):
+        calls.append(sorted(note.id for note in notes))
+        return update_notes(notes, **kwargs)
+    monkeypatch.setattr(col, 'update_notes', update)
+    return calls
@@ -0,0 +1,143 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+from typing import Iterable
+
+from anki import buildinfo, notes_pb2
+from anki.collection import Collection
+from anki.notes import Note, NoteId
+from anki.utils import ids2str, split_fields
+
+from .instrument import phase
+from .spans import Document, parse
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _anki_version() -> tuple[int, int]:
+    major, minor = buildinfo.version.split('.')[:2]
+    return int(major), int(minor)
+
+
+# Building notes from rows of the notes table relies on private APIs, checked with these Anki versions only.
+# Other versions load notes one by one through the public API.
+FAST_LOAD = _anki_version() in {(24, 6)} and hasattr(Note, '_load_from_backend_note')
+
+
+def get_notes(col: Collection, nids: Iterable[int]) -> dict[int, Note]:
+    '''
+    Load notes with a single query instead of a backend call per note. Missing notes are left out.
+    '''
+    with phase('load'):
+        if not FAST_LOAD:
+            existing = col.db.list(f'select id from notes where id in {ids2str(nids)}')
+            return {nid: col.get_note(NoteId(nid)) for nid in existing}
+        return _notes_from_rows(col, nids)
+
+
+def _notes_from_rows(col: Collection, nids: Iterable[int]) -> dict[int, Note]:
+    notes = {}
+    rows = col.db.execute(f'select id, guid, mid, mod, usn, tags, flds from notes where id in {ids2str(nids)}')
+    for nid, guid, mid, mod, usn, tags, flds in rows:
+        note = Note.__new__(Note)
+        note.col = col.weakref()
+        note._load_from_backend_note(notes_pb2.Note(
+            id=nid, guid=guid, notetype_id=mid, mtime_secs=mod, usn=usn,
+            tags=col.tags.split(tags), fields=split_fields(flds),
+        ))
+        notes[nid] = note
+    return notes
+
+
+class Documents():
+    '''
+    Parsed fields shared by all sync stages of a single operation.
+    Each field is parsed at most once and changed notes are written once by flush.
+    '''
+
+    def __init__(self):
+        self.notes: dict[int, Note] = {}
+        # (nid, field_idx) -> (hash of the field the document was parsed from, document)
+        self.docs: dict[tuple[int, int], tuple[str, Document]] = {}
+        self.changed: set[tuple[int, int]] = set()
+        # Notes with fields replaced as a whole by update
+        self.updated: set[int] = set()
+
+    def note(self, col: Collection, nid: NoteId) -> Note:
+        note = self.notes.get(nid)
+        if note is None:
+            with phase('load'):
+                note = col.get_note(nid)
+            self.notes[nid] = note
+        return note
+
+    def preload(self, col: Collection, nids: Iterable[int]):
+        missing = [nid for nid in nids if nid not in self.notes]
+        if len(missing) > 0:
+            self.notes.update(get_notes(col, missing))
+
+    def get(self, note: Note, field_idx: int) -> Document:
+        self.notes.setdefault(note.id, note)
+        key = (note.id, field_idx)
+        digest = content_hash(note.fields[field_idx])
+        cached = self.docs.get(key)
+        if cached is not None and cached[0] == digest:
+            return cached[1]
+        # The field was changed behind our back, pending changes to the old document are lost
+        self.changed.discard(key)
+        with phase('parse'):
+            doc = parse(note.fields[field_idx])
+        self.docs[key] = (digest, doc)
+        return doc
+
+    def mark_changed(self, note: Note, field_idx: int):
+        self.changed.add((note.id, field_idx))
+
+    def update(self, note: Note, field_idx: int, text: str):
+        '''
+        Replace the whole field, e.g. with text rendered elsewhere. Saved by flush.
+        '''
+        self.notes.setdefault(note.id, note)
+        if note.fields[field_idx] == text:
+            return
+        note.fields[field_idx] = text
+        self.docs.pop((note.id, field_idx), None)
+        self.changed.discard((note.id, field_idx))
+        self.updated.add(note.id)
+
+    def flush(self, col: Collection) -> set[int]:
+        '''
+        Serialize changed documents into their notes and save them. Return ids of saved notes.
+        '''
+        nids = set(self.updated)
+        for key in self.changed:
+            nid, field_idx = key
+            note = self.notes[nid]
+            text = self.docs[key][1].encode()
+            # Offsets of the spans refer to the old text, parse again if needed
+            del self.docs[key]
+            if text == note.fields[field_idx]:
+                continue  # spans were set to what they already were
+            note.fields[field_idx] = text
+            nids.add(nid)
+        self.changed.clear()
+        self.updated.clear()
+        if len(nids) > 0:
+            with phase('save'):
+                col.update_notes([self.notes[nid] for nid in nids])
+        return nids
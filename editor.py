@@ -0,0 +1,136 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from typing import Iterable, Mapping
+
+from anki.collection import Collection
+from anki.notes import Note
+
+from . import bidir, unidir
+from .documents import Documents, get_notes
+from .instrument import phase
+from .spans import Span, has_sync_spans, parse
+
+
+class Snapshot():
+    '''
+    Sync spans of a field when it gained focus. Spans which are the same on unfocus need no sync.
+    '''
+
+    def __init__(self, field: str):
+        doc = parse(field) if has_sync_spans(field) else None
+        spans = doc.find() if doc is not None else []
+        # Whole unidirectional spans, a change of the note attribute or of the content needs a render
+        self.unidir = {span.html for span in spans if span.has_attr('note')}
+        # sid -> content hashes of bidirectional spans
+        self.bidir: dict[str, set[str]] = {}
+        for span in spans:
+            if not span.has_attr('note') and span.has_attr('sid'):
+                self.bidir.setdefault(span.get('sid'), set()).add(bidir.span_hash(span))
+
+    def unidir_changed(self, span: Span) -> bool:
+        return span.html not in self.unidir
+
+    def bidir_changed(self, span: Span) -> bool:
+        return bidir.span_hash(span) not in self.bidir.get(span.get('sid'), ())
+
+
+# (nid, field_idx) -> snapshot of the focused field
+snapshots: dict[tuple[int, int], Snapshot] = {}
+
+
+def on_focus(note: Note, field_idx: int):
+    if note.id == 0 or field_idx < 0 or field_idx >= len(note.fields):
+        return
+    # A snapshot still waiting for its sync is older, so it covers all edits since
+    snapshots.setdefault((note.id, field_idx), Snapshot(note.fields[field_idx]))
+
+
+def _sync_field(col: Collection, note: Note, field_idx: int, popup: bidir.Popup, docs: Documents) -> bool:
+    snapshot = snapshots.pop((note.id, field_idx), None)
+    unidir_only = snapshot.unidir_changed if snapshot is not None else None
+    bidir_only = snapshot.bidir_changed if snapshot is not None else None
+    with phase('editor', note.note_type()['name']):
+        changed = unidir.sync_field(col, note, field_idx, docs, unidir_only)
+        changed |= bidir.sync_field(col, note, field_idx, popup, docs, bidir_only)
+    return changed
+
+
+def sync_field(col: Collection, note: Note, field_idx: int, popup: bidir.Popup = bidir.default_popup) -> bool:
+    '''
+    Sync spans of the field added or edited since it gained focus, or all of them without a snapshot.
+    '''
+    docs = Documents()
+    changed = _sync_field(col, note, field_idx, popup, docs)
+    docs.flush(col)
+    return changed
+
+
+def sync_notes(col: Collection, fields: Iterable[tuple[Note, Iterable[int]]],
+               popup: bidir.Popup = bidir.default_popup) -> set[int]:
+    '''
+    Sync fields of several notes like sync_field and save them at once. Return ids of saved notes.
+    '''
+    fields = list(fields)
+    docs = Documents()
+    # The given notes are the ones updated, even when they are also a source or target of another note
+    for note, _ in fields:
+        docs.notes[note.id] = note
+    for note, field_idxs in fields:
+        for field_idx in sorted(field_idxs):
+            _sync_field(col, note, field_idx, popup, docs)
+    return docs.flush(col)
+
+
+class SyncQueue():
+    '''
+    Fields unfocused in editors, coalesced per note until flush syncs them in one batch.
+    Notes are loaded again when flushed, editors save them before the unfocus hooks run.
+    '''
+
+    def __init__(self):
+        # nid -> field indices
+        self.pending: dict[int, set[int]] = {}
+
+    def add(self, note: Note, field_idx: int):
+        if note.id == 0:
+            return  # the card is being created
+        self.pending.setdefault(note.id, set()).add(field_idx)
+
+    def take(self) -> dict[int, set[int]]:
+        pending, self.pending = self.pending, {}
+        return pending
+
+    def flush(self, col: Collection, popup: bidir.Popup = bidir.default_popup) -> set[int]:
+        return sync_pending(col, self.take(), popup)
+
+
+def sync_pending(col: Collection, pending: dict[int, set[int]], popup: bidir.Popup = bidir.default_popup,
+                 shown: Mapping[int, Note] | None = None) -> set[int]:
+    '''
+    Sync fields taken from a SyncQueue, possibly in the background. Return ids of saved notes.
+    Notes shown in editors are synced in the editor's own object, a later save of the editor keeps the changes.
+    '''
+    if len(pending) == 0:
+        return set()
+    notes = get_notes(col, pending)
+    if shown is not None:
+        notes.update({nid: note for nid, note in shown.items() if nid in notes})
+    return sync_notes(col, [(notes[nid], field_idxs) for nid, field_idxs in pending.items() if nid in notes], popup)
+
+
+queue = SyncQueue()
+# Conflicts found by the queue, shown together instead of a popup per span
+conflicts = bidir.ConflictQueue()
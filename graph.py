@@ -0,0 +1,64 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from typing import Callable, Hashable, Iterable, TypeVar
+
+T = TypeVar('T', bound=Hashable)
+
+
+def strongly_connected(nodes: Iterable[T], edges: Callable[[T], Iterable[T]]) -> list[list[T]]:
+    '''
+    Tarjan's algorithm without recursion. A component is returned only after all components
+    it has edges to, i.e. dependencies come first.
+    '''
+    index: dict[T, int] = {}
+    lowlink: dict[T, int] = {}
+    stack: list[T] = []
+    on_stack: set[T] = set()
+    components = []
+
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(edges(root)))]
+        while len(work) > 0:
+            node, it = work[-1]
+            for succ in it:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(edges(succ))))
+                    break
+                if succ in on_stack:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            else:
+                work.pop()
+                if len(work) > 0:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
@@ -0,0 +1,259 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Hooks and menus of the add-on inside Anki. Sync modules are imported when first needed.
+'''
+
+import os
+import weakref
+from functools import partial
+from typing import Callable
+
+import anki.collection  # isort:skip # noqa: F401
+from anki.collection import OpChangesAfterUndo, OpChangesWithCount
+from anki.notes import Note
+from aqt import gui_hooks, mw
+from aqt.errors import show_exception
+from aqt.operations import CollectionOp
+from aqt.qt import QAction, QMenu, QTimer, qconnect
+from aqt.utils import showText, tooltip
+
+from . import instrument
+
+USER_FILES = os.path.join(os.path.dirname(__file__), 'user_files')
+TIMINGS_LOG = os.path.join(USER_FILES, 'timings.log')
+PROFILE = os.path.join(USER_FILES, 'refresh_all.prof')
+# Unfocused fields are synced once no other field was unfocused for this long
+DEBOUNCE_MS = 500
+
+editors = weakref.WeakSet()
+flush_timer = None
+
+
+def flush_editor_queue():
+    '''
+    Sync the queued fields in a collection op, after pending saves of the editor and before or after a refresh.
+    '''
+    from . import editor
+
+    if flush_timer is not None:
+        flush_timer.stop()
+    pending = editor.queue.take()
+    if len(pending) == 0 or mw.col is None:
+        return
+    # Later saves of an editor write its own note object, the sync has to change that one
+    shown = {ed.note.id: ed.note for ed in editors if ed.note is not None and ed.note.id in pending}
+    conflicts = {}
+
+    def op(col: anki.collection.Collection) -> OpChangesWithCount:
+        nonlocal conflicts
+        saved = editor.sync_pending(col, pending, editor.conflicts, shown)
+        if len(editor.conflicts) > 0:
+            conflicts = editor.conflicts.take(col)
+        out = OpChangesWithCount()
+        out.count = len(saved)
+        # Browser and current card editors reload their note on this change
+        out.changes.note_text = len(saved) > 0
+        return out
+
+    def on_success(out: OpChangesWithCount):
+        if len(conflicts) > 0:
+            from . import review
+            review.show(conflicts)
+
+    CollectionOp(parent=mw, op=op).success(on_success).run_in_background()
+
+
+def close_all_windows(close: Callable[[Callable[[], None]], None], onsuccess: Callable[[], None]):
+    '''
+    Wraps AnkiQt.closeAllWindows. Editors save their notes and unfocus their fields while their windows close,
+    the queued fields are synced after that and before the collection is closed or replaced.
+    '''
+    from . import editor
+    from .index import NoteIndex
+
+    def flush():
+        if flush_timer is not None:
+            flush_timer.stop()
+        if mw.col is None:
+            onsuccess()
+            return
+        pending = editor.queue.take()
+
+        def op(col: anki.collection.Collection) -> OpChangesWithCount:
+            out = OpChangesWithCount()
+            out.count = len(editor.sync_pending(col, pending, editor.conflicts))
+            out.changes.note_text = out.count > 0
+            # No window is left to show conflicts, they are left to the next refresh
+            editor.conflicts.sids.clear()
+            # Indexes refreshed by editor syncs are saved once, not after every field
+            NoteIndex.save_all()
+            return out
+
+        def on_failure(exc: Exception):
+            show_exception(parent=mw, exception=exc)
+            onsuccess()
+
+        # Collection ops run in order, the ones still using the indexes finish first
+        CollectionOp(parent=mw, op=op).success(lambda _: onsuccess()).failure(on_failure).run_in_background()
+
+    close(flush)
+
+
+def on_editor_did_unfocus_field(changed: bool, note: Note, field_idx: int) -> bool:
+    # Synced later, editors showing changed notes are reloaded then
+    global flush_timer
+    from . import editor
+
+    editor.queue.add(note, field_idx)
+    if flush_timer is None:
+        flush_timer = QTimer(mw)
+        flush_timer.setSingleShot(True)
+        qconnect(flush_timer.timeout, flush_editor_queue)
+    flush_timer.start(DEBOUNCE_MS)
+    return changed
+
+
+def on_editor_did_focus_field(note: Note, field_idx: int):
+    from . import editor
+
+    editor.on_focus(note, field_idx)
+
+
+def on_state_did_undo(out: OpChangesAfterUndo):
+    from .index import NoteIndex
+
+    # Undone notes get their older mod back, which an incremental refresh would not pick up
+    if out.changes.note_text:
+        NoteIndex.invalidate_all()
+
+
+def on_editor_did_init(ed):
+    editors.add(ed)
+
+
+def config() -> dict:
+    return mw.addonManager.getConfig(__name__) or {}
+
+
+def refresh_all(label: str):
+    from . import bidir, unidir
+
+    policy = config().get('bidir_policy', 'report')
+    conflicts = {}
+
+    def progress(done: int, total: int) -> bool:
+        mw.taskman.run_on_main(lambda: mw.progress.update(label=f'{label} {done}/{total}', value=done, max=total))
+        return not mw.progress.want_cancel()
+
+    def op(col: anki.collection.Collection) -> OpChangesWithCount:
+        nonlocal conflicts
+        # Bidirectional first, notes saved by the render would look like the most recent ones.
+        # Dialogs cannot be shown from the background, conflicts to prompt for are reviewed after the op.
+        out = bidir.sync_all_op(col, bidir.newest if policy == 'newest' else bidir.skip)
+        if policy != 'newest':
+            conflicts = bidir.conflicts(col)
+        other = unidir.sync_all_op(col, progress)
+        out.count += other.count
+        out.changes.MergeFrom(other.changes)
+        return out
+
+    def on_success(out: OpChangesWithCount):
+        tooltip(f'Notesync: {out.count} notes updated', parent=mw)
+        if len(conflicts) == 0:
+            return
+        if policy == 'prompt':
+            from . import review
+            review.show(conflicts)
+        else:
+            tooltip(f'Notesync: Bidirectional spans differ for {len(conflicts)} sids', parent=mw)
+
+    def on_failure(exc: Exception):
+        if isinstance(exc, unidir.Cancelled):
+            tooltip('Notesync: Refresh cancelled', parent=mw)
+        else:
+            show_exception(parent=mw, exception=exc)
+
+    CollectionOp(parent=mw, op=op).success(on_success).failure(on_failure).with_progress(label).run_in_background()
+
+
+def on_sync_will_start():
+    flush_editor_queue()
+    # Collection tasks run one at a time in the order they were submitted. The sync is submitted
+    # right after this hook returns, so it always starts after the refresh has finished.
+    refresh_all('Notesync: Refreshing notes before sync')
+
+
+def on_refresh_all():
+    refresh_all('Notesync: Refreshing notes')
+
+
+def on_toggle_timings(checked: bool):
+    instrument.enabled = checked
+
+
+def on_show_timings():
+    showText(instrument.stats.summary(), parent=mw, title='Notesync timings', copyBtn=True, plain_text_edit=True)
+
+
+def on_export_timings():
+    instrument.stats.export(TIMINGS_LOG)
+    tooltip(f'Notesync: Timings appended to {TIMINGS_LOG}', parent=mw)
+
+
+def on_profile_refresh_all():
+    from . import unidir
+
+    profiler = None
+
+    def op(col: anki.collection.Collection) -> OpChangesWithCount:
+        nonlocal profiler
+        out, profiler = instrument.profile(unidir.sync_all_op, col)
+        return out
+
+    def on_success(out: OpChangesWithCount):
+        profiler.dump_stats(PROFILE)
+        showText(f'{out.count} notes updated, profile saved to {PROFILE}\n\n{instrument.profile_summary(profiler)}',
+                 parent=mw, title='Notesync profile', copyBtn=True, plain_text_edit=True)
+
+    CollectionOp(parent=mw, op=op).success(on_success).with_progress('Notesync: Profiling').run_in_background()
+
+
+def on_main_window_did_init():
+    mw.closeAllWindows = partial(close_all_windows, mw.closeAllWindows)
+
+    action = QAction('Notesync: Refresh all', mw)
+    qconnect(action.triggered, on_refresh_all)
+    mw.form.menuTools.addAction(action)
+
+    menu = QMenu('Notesync: Diagnostics', mw)
+    action = menu.addAction('Record timings')
+    action.setCheckable(True)
+    qconnect(action.toggled, on_toggle_timings)
+    qconnect(menu.addAction('Show timings').triggered, on_show_timings)
+    qconnect(menu.addAction('Export timings').triggered, on_export_timings)
+    qconnect(menu.addAction('Reset timings').triggered, instrument.stats.clear)
+    menu.addSeparator()
+    qconnect(menu.addAction('Profile refresh all').triggered, on_profile_refresh_all)
+    mw.form.menuTools.addMenu(menu)
+
+
+gui_hooks.editor_did_init.append(on_editor_did_init)
+gui_hooks.editor_did_focus_field.append(on_editor_did_focus_field)
+gui_hooks.editor_did_unfocus_field.append(on_editor_did_unfocus_field)
+gui_hooks.sync_will_start.append(on_sync_will_start)
+gui_hooks.main_window_did_init.append(on_main_window_did_init)
+gui_hooks.state_did_undo.append(on_state_did_undo)
@@ -0,0 +1,221 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Any
+
+from anki.collection import Collection
+from anki.utils import ids2str, split_fields
+
+from .instrument import phase
+from .spans import has_sync_spans
+
+
+def sidecar_path(col: Collection, name: str) -> str:
+    # Indexes live next to the collection file, so they never end up in the synced collection
+    return f'{os.path.splitext(col.path)[0]}.notesync-{name}.json'
+
+
+def schema_mod(col: Collection) -> int:
+    return col.db.scalar('select scm from col')
+
+
+class NoteIndex(ABC):
+    '''
+    Per-field index of sync spans, persisted next to the collection file.
+    Only notes modified since the last refresh, or whose mod differs from the one they were scanned with,
+    are rescanned. Refreshes are saved by save or save_all at the end of an operation,
+    a lost save only means the notes are rescanned again.
+    '''
+    NAME = ''
+    VERSION = 1
+
+    _cache: dict[str, 'NoteIndex'] = {}
+
+    def __init__(self, path: str):
+        self.path = path
+        self.scm = None
+        # Notes modified at or after the checkpoint (or synced with a higher usn) must be rescanned
+        self.checkpoint = 0
+        self.usn = -1
+        # nid -> field_idx -> entry returned by scan_field
+        self.notes: dict[int, dict[int, Any]] = {}
+        # nid -> mod of the indexed note when it was scanned
+        self.scanned: dict[int, int] = {}
+        # Set when notes may have gone back to an older mod, e.g. by undo, the next refresh rescans all of them
+        self.stale = False
+        # Count and total mod of all notes at the last refresh, mods of indexed notes are compared when it changes
+        self.fingerprint: tuple[int, float] | None = None
+        self.unsaved = False
+
+    @classmethod
+    def get(cls, col: Collection):
+        path = sidecar_path(col, cls.NAME)
+        index = cls._cache.get(path)
+        if index is None:
+            index = cls.load(path)
+            cls._cache[path] = index
+        return index
+
+    @classmethod
+    def load(cls, path: str):
+        index = cls(path)
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return index
+        if data.get('version') != cls.VERSION:
+            return index
+
+        index.scm = data['scm']
+        index.checkpoint = data['checkpoint']
+        index.usn = data['usn']
+        index.restore(data)
+        for nid, fields in data['notes'].items():
+            fields = {int(field_idx): entry for field_idx, entry in fields.items()}
+            index.set_note(int(nid), data['scanned'][nid], fields)
+        return index
+
+    def save(self):
+        data = {
+            'version': self.VERSION,
+            'scm': self.scm,
+            'checkpoint': self.checkpoint,
+            'usn': self.usn,
+            'notes': self.notes,
+            'scanned': self.scanned,
+        }
+        data.update(self.dump())
+        # dumps uses the C encoder, dump writing to a file does not
+        text = json.dumps(data)
+        with open(self.path, 'w') as f:
+            f.write(text)
+        self.unsaved = False
+
+    @classmethod
+    def save_all(cls):
+        for index in cls._cache.values():
+            if index.unsaved:
+                index.save()
+
+    @classmethod
+    def invalidate_all(cls):
+        '''
+        Rescan all notes on the next refresh of each index, after rows were put back by an undo.
+        Indexed notes are checked by their mod anyway, but undo may also restore spans in notes without any.
+        '''
+        for index in cls._cache.values():
+            index.stale = True
+
+    def dump(self) -> dict:
+        return {}
+
+    def restore(self, data: dict):
+        pass
+
+    @abstractmethod
+    def scan_field(self, field: str) -> Any:
+        '''
+        Return an index entry for the field or None if there is nothing to index.
+        '''
+
+    def link(self, nid: int, field_idx: int, entry: Any):
+        pass
+
+    def unlink(self, nid: int, field_idx: int, entry: Any):
+        pass
+
+    def refreshed(self):
+        '''
+        Called after notes were rescanned, before the index is saved.
+        '''
+        pass
+
+    def set_note(self, nid: int, mod: int, fields: dict[int, Any]):
+        self.remove_note(nid)
+        if len(fields) == 0:
+            return
+        self.notes[nid] = fields
+        self.scanned[nid] = mod
+        for field_idx, entry in fields.items():
+            self.link(nid, field_idx, entry)
+
+    def remove_note(self, nid: int):
+        self.scanned.pop(nid, None)
+        for field_idx, entry in self.notes.pop(nid, {}).items():
+            self.unlink(nid, field_idx, entry)
+
+    def refresh(self, col: Collection) -> set[int]:
+        '''
+        Rescan notes modified since the last refresh and return their ids.
+        A full scan is done when the index is missing or the schema has changed.
+        '''
+        with phase(f'index.{self.NAME}'):
+            return self.__refresh(col)
+
+    def __scan(self, nid: int, mod: int, flds: str):
+        if not has_sync_spans(flds) and nid not in self.notes:
+            return
+        fields = {}
+        for field_idx, field_val in enumerate(split_fields(flds)):
+            if not has_sync_spans(field_val):
+                continue
+            entry = self.scan_field(field_val)
+            if entry is not None:
+                fields[field_idx] = entry
+        self.set_note(nid, mod, fields)
+
+    def __refresh(self, col: Collection) -> set[int]:
+        start = int(time.time())
+        if self.scm is None or self.scm != schema_mod(col):
+            self.__init__(self.path)
+            self.scm = schema_mod(col)
+        if self.stale:
+            self.stale = False
+            self.checkpoint = 0
+            self.usn = -1
+
+        fingerprint = tuple(col.db.first('select count(), total(mod) from notes'))
+
+        # Modified locally (mod) or by a sync (usn)
+        dirty = set()
+        for nid, mod, flds in col.db.execute('select id, mod, flds from notes where mod >= ? or usn > ?',
+                                             self.checkpoint, self.usn):
+            dirty.add(nid)
+            self.__scan(nid, mod, flds)
+
+        # Deleted notes and rows put back by an undo, with their older mod, are found by comparing the mods
+        if fingerprint != self.fingerprint:
+            mods = dict(col.db.execute(f'select id, mod from notes where id in {ids2str(self.notes)}'))
+            changed = [nid for nid, mod in self.scanned.items() if mods.get(nid) != mod]
+            for nid in changed:
+                if nid not in mods:
+                    self.remove_note(nid)
+            for nid, mod, flds in col.db.execute(f'select id, mod, flds from notes where id in {ids2str(changed)}'):
+                self.__scan(nid, mod, flds)
+            dirty.update(changed)
+        self.fingerprint = fingerprint
+
+        self.checkpoint = start
+        usn = col.db.scalar('select max(usn) from notes')
+        self.usn = usn if usn is not None else -1
+        self.refreshed()
+        if len(dirty) > 0:
+            self.unsaved = True
+        return dirty
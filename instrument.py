@@ -0,0 +1,106 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from typing import TYPE_CHECKING, Any, Callable
+
+if TYPE_CHECKING:
+    import cProfile
+
+# Off by default, a disabled phase costs a single check
+enabled = False
+
+
+class Stats():
+    '''
+    Counts and cumulative durations of phases, optionally split by a detail such as a note type or a sid.
+    Nested phases are included in the duration of the outer one.
+    '''
+
+    def __init__(self):
+        self.counts: dict[tuple[str, str | None], int] = defaultdict(int)
+        self.durations: dict[tuple[str, str | None], float] = defaultdict(float)
+
+    def add(self, name: str, detail: str | None, seconds: float):
+        self.counts[(name, detail)] += 1
+        self.durations[(name, detail)] += seconds
+
+    def clear(self):
+        self.counts.clear()
+        self.durations.clear()
+
+    def summary(self) -> str:
+        lines = [f'{"phase":<40} {"count":>8} {"total ms":>12} {"avg ms":>10}']
+        for key, seconds in sorted(self.durations.items(), key=lambda item: (item[0][0], -item[1])):
+            name, detail = key
+            label = name if detail is None else f'{name} [{detail}]'
+            count = self.counts[key]
+            lines.append(f'{label:<40} {count:>8} {seconds * 1000:>12.1f} {seconds * 1000 / count:>10.3f}')
+        return '\n'.join(lines)
+
+    def export(self, path: str):
+        with open(path, 'a') as f:
+            f.write(f'# {time.strftime("%Y-%m-%d %H:%M:%S")}\n{self.summary()}\n\n')
+
+
+stats = Stats()
+
+
+class _Phase():
+    __slots__ = ('name', 'detail', 'start')
+
+    def __init__(self, name: str, detail: str | None):
+        self.name = name
+        self.detail = detail
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        stats.add(self.name, self.detail, time.perf_counter() - self.start)
+
+
+_DISABLED = nullcontext()
+
+
+def phase(name: str, detail: Any = None):
+    if not enabled:
+        return _DISABLED
+    return _Phase(name, None if detail is None else str(detail))
+
+
+def count(name: str, detail: Any = None):
+    if enabled:
+        stats.add(name, None if detail is None else str(detail), 0.0)
+
+
+def profile(func: Callable, *args, **kwargs) -> tuple[Any, 'cProfile.Profile']:
+    '''
+    Run func under cProfile. Return its result and the profiler.
+    '''
+    import cProfile
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func, *args, **kwargs)
+    return result, profiler
+
+
+def profile_summary(profiler: 'cProfile.Profile', limit: int = 40) -> str:
+    import io
+    import pstats
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+    return out.getvalue()
@@ -0,0 +1,139 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+from anki.collection import Collection, OpChangesWithCount
+from anki.utils import strip_html
+from aqt import mw
+from aqt.operations import CollectionOp
+from aqt.qt import (QComboBox, QDialog, QDialogButtonBox, QHBoxLayout, QHeaderView, QLabel, QPushButton, QTableWidget,
+                    QTableWidgetItem, QVBoxLayout, qconnect)
+from aqt.utils import tooltip
+
+from . import bidir
+from .spans import Span
+
+PREVIEW_CHARS = 80
+
+
+def label(action: str, span: Span) -> str:
+    text = strip_html(span.inner)
+    return f'{action}: {text[:PREVIEW_CHARS]}{"…" if len(text) > PREVIEW_CHARS else ""}'
+
+
+class ReviewDialog(QDialog):
+    '''
+    Non-modal list of sids whose spans differ. Choices are written together once applied.
+    '''
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        # sid -> versions, newest (the one just edited) first
+        self.conflicts: dict[str, list[Span]] = {}
+        # sid -> content hashes of the listed versions, a sid edited since is not resolved
+        self.hashes: dict[str, set[str]] = {}
+        self.combos: dict[str, QComboBox] = {}
+
+        self.setWindowTitle('Notesync: Conflicts')
+        self.resize(700, 400)
+        layout = QVBoxLayout(self)
+        layout.addWidget(QLabel('Upload keeps the most recently edited version, Download the one from other notes.'))
+
+        self.table = QTableWidget(0, 2)
+        self.table.setHorizontalHeaderLabels(['Sid', 'Resolution'])
+        self.table.horizontalHeader().setSectionResizeMode(1, QHeaderView.ResizeMode.Stretch)
+        self.table.verticalHeader().hide()
+        layout.addWidget(self.table)
+
+        row = QHBoxLayout()
+        for text, idx in (('Upload all', 0), ('Download all', 1), ('Skip all', -1)):
+            button = QPushButton(text)
+            qconnect(button.clicked, lambda _, idx=idx: self.choose_all(idx))
+            row.addWidget(button)
+        row.addStretch()
+        layout.addLayout(row)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.StandardButton.Apply | QDialogButtonBox.StandardButton.Cancel)
+        qconnect(buttons.button(QDialogButtonBox.StandardButton.Apply).clicked, self.apply)
+        qconnect(buttons.rejected, self.reject)
+        layout.addWidget(buttons)
+
+    def add(self, conflicts: dict[str, list[Span]]):
+        for sid, spans in conflicts.items():
+            combo = self.combos.get(sid)
+            if combo is None:
+                combo = QComboBox()
+                row = self.table.rowCount()
+                self.table.insertRow(row)
+                self.table.setItem(row, 0, QTableWidgetItem(sid))
+                self.table.setCellWidget(row, 1, combo)
+                self.combos[sid] = combo
+            combo.clear()
+            combo.addItems([label('Upload' if i == 0 else 'Download', span) for i, span in enumerate(spans)])
+            combo.addItem('Skip')
+            self.conflicts[sid] = spans
+            self.hashes[sid] = {bidir.span_hash(span) for span in spans}
+
+    def choose_all(self, idx: int):
+        for combo in self.combos.values():
+            # Rows with fewer versions fall back to their last one
+            combo.setCurrentIndex(min(idx, combo.count() - 2) if idx >= 0 else combo.count() - 1)
+
+    def apply(self):
+        chosen = {}
+        for sid, combo in self.combos.items():
+            idx = combo.currentIndex()
+            if idx < len(self.conflicts[sid]):
+                chosen[sid] = self.conflicts[sid][idx]
+        seen = {sid: self.hashes[sid] for sid in chosen}
+        self.accept()
+        if len(chosen) == 0:
+            return
+        queue = bidir.ConflictQueue()
+        skipped = []
+        conflicts = {}
+
+        def op(col: Collection) -> OpChangesWithCount:
+            nonlocal conflicts
+            out = bidir.resolve_op(col, chosen, seen, queue)
+            skipped.extend(queue.sids)
+            conflicts = queue.take(col)
+            return out
+
+        def on_success(out: OpChangesWithCount):
+            message = f'Notesync: {out.count} notes updated'
+            if len(skipped) > 0:
+                message += f', {len(skipped)} sids edited since they were listed are not resolved'
+            tooltip(message, parent=mw)
+            show(conflicts)
+
+        CollectionOp(parent=mw, op=op).success(on_success).run_in_background()
+
+
+dialog: ReviewDialog | None = None
+
+
+def show(conflicts: dict[str, list[Span]]):
+    '''
+    Add conflicts to the review dialog, opening it if needed. Never blocks.
+    '''
+    global dialog
+    if len(conflicts) == 0:
+        return
+    if dialog is None or not dialog.isVisible():
+        dialog = ReviewDialog(mw)
+    dialog.add(conflicts)
+    dialog.show()
+    dialog.raise_()
@@ -0,0 +1,317 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import html
+import re
+import warnings
+from functools import cache
+from html.parser import HTMLParser
+
+# Opening tag of a span which may have the sync class. False positives are fine, false negatives are not.
+# Quoted values of earlier attributes are skipped as a whole, they may contain '>'.
+RE_SYNC_SPAN = re.compile(
+    r'''<span\s(?:[^>"']|"[^"]*"|'[^']*')*?\bclass\s*=\s*(?:"[^"]*?\bsync\b|'[^']*?\bsync\b|sync\b)''',
+    re.IGNORECASE,
+)
+
+# Elements closed right after they are opened, same as in BeautifulSoup
+VOID_ELEMENTS = {
+    'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image', 'img',
+    'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source', 'spacer', 'track',
+    'wbr',
+}
+
+
+def has_sync_spans(field: str) -> bool:
+    return 'sync' in field and RE_SYNC_SPAN.search(field) is not None
+
+
+def is_sync(attrs: dict[str, str | None]) -> bool:
+    return 'sync' in (attrs.get('class') or '').split()
+
+
+class Span():
+    '''
+    Top-level sync span of a field, kept as the raw text it was parsed from.
+    '''
+
+    def __init__(self, tag: str, attrs: dict[str, str | None], inner: str, close: str,
+                 start: int = 0, end: int = 0):
+        self.tag = tag
+        self.attrs = attrs
+        self.inner = inner
+        # Empty for self-closing and unclosed spans
+        self.close = close
+        # Offsets of the span in the original field
+        self.start = start
+        self.end = end
+        self.changed = False
+
+    @property
+    def html(self) -> str:
+        return self.tag + self.inner + self.close
+
+    def get(self, name: str, default: str | None = None) -> str | None:
+        return self.attrs.get(name, default)
+
+    def has_attr(self, name: str) -> bool:
+        return name in self.attrs
+
+    def matches(self, attrs: dict[str, bool | str]) -> bool:
+        for name, value in attrs.items():
+            if value is True or value is False:
+                if self.has_attr(name) != value:
+                    return False
+            elif self.get(name) != value:
+                return False
+        return True
+
+
+class _Scanner(HTMLParser):
+    '''
+    Find top-level sync spans the same way BeautifulSoup with html.parser would.
+    '''
+
+    def __init__(self, text: str):
+        super().__init__(convert_charrefs=False)
+        self.text = text
+        self.line_offsets = [0] + [m.end() for m in re.finditer('\n', text)]
+        self.stack: list[str] = []
+        self.spans: list[Span] = []
+        self.open: Span | None = None
+
+    def position(self) -> int:
+        line, col = self.getpos()
+        return self.line_offsets[line - 1] + col
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]):
+        if tag in VOID_ELEMENTS:
+            return
+        if len(self.stack) == 0 and tag == 'span':
+            attrs_dict = dict(attrs)
+            if is_sync(attrs_dict):
+                start = self.position()
+                self.open = Span(self.get_starttag_text(), attrs_dict, '', '', start, start)
+        self.stack.append(tag)
+
+    def handle_startendtag(self, tag: str, attrs: list[tuple[str, str | None]]):
+        if len(self.stack) > 0 or tag != 'span':
+            return
+        attrs_dict = dict(attrs)
+        if is_sync(attrs_dict):
+            start = self.position()
+            text = self.get_starttag_text()
+            self.spans.append(Span(text, attrs_dict, '', '', start, start + len(text)))
+
+    def handle_endtag(self, tag: str):
+        if tag not in self.stack:
+            return  # stray end tag
+        while self.stack.pop() != tag:
+            pass
+        if len(self.stack) == 0 and self.open is not None:
+            span = self.open
+            close_start = self.position()
+            span.end = self.text.index('>', close_start) + 1
+            span.inner = self.text[span.start + len(span.tag):close_start]
+            span.close = self.text[close_start:span.end]
+            self.spans.append(span)
+            self.open = None
+
+    def scan(self) -> list[Span]:
+        self.feed(self.text)
+        self.close()
+        if self.open is not None:
+            span = self.open
+            span.end = len(self.text)
+            span.inner = self.text[span.start + len(span.tag):]
+            self.spans.append(span)
+            self.open = None
+        return self.spans
+
+
+class _Balancer(HTMLParser):
+    '''
+    Copy markup dropping stray end tags and closing elements left open, like BeautifulSoup would.
+    '''
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.out: list[str] = []
+        self.stack: list[str] = []
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]):
+        self.out.append(self.get_starttag_text())
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(tag)
+
+    def handle_startendtag(self, tag: str, attrs: list[tuple[str, str | None]]):
+        self.out.append(self.get_starttag_text())
+
+    def handle_endtag(self, tag: str):
+        if tag not in self.stack:
+            return
+        while True:
+            open_tag = self.stack.pop()
+            self.out.append(f'</{open_tag}>')
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data: str):
+        self.out.append(data)
+
+    def handle_entityref(self, name: str):
+        self.out.append(f'&{name};')
+
+    def handle_charref(self, name: str):
+        self.out.append(f'&#{name};')
+
+    def handle_comment(self, data: str):
+        self.out.append(f'<!--{data}-->')
+
+    def handle_decl(self, decl: str):
+        self.out.append(f'<!{decl}>')
+
+    def handle_pi(self, data: str):
+        self.out.append(f'<?{data}>')
+
+    def unknown_decl(self, data: str):
+        self.out.append(f'<![{data}]>')
+
+    def balance(self, text: str) -> str:
+        self.feed(text)
+        self.close()
+        self.out.extend(f'</{tag}>' for tag in reversed(self.stack))
+        return ''.join(self.out)
+
+
+def balance(text: str) -> str:
+    '''
+    Return text which can be the content of a sync span. Well-formed text is returned as it is.
+    '''
+    if '<' not in text:
+        return text
+    wrapped = f'<span class="sync">{text}</span>'
+    spans = _Scanner(wrapped).scan()
+    if len(spans) == 1 and spans[0].html == wrapped and spans[0].close != '':
+        return text
+    return _Balancer().balance(text)
+
+
+class Document():
+    '''
+    Field split into its top-level sync spans. Text outside of changed spans is never rewritten.
+    '''
+
+    def __init__(self, text: str):
+        self.text = text
+        self.spans = _Scanner(text).scan() if has_sync_spans(text) else []
+
+    def find(self, **attrs: bool | str) -> list[Span]:
+        return [span for span in self.spans if span.matches(attrs)]
+
+    def replace(self, span: Span, html: str):
+        idx = self.spans.index(span)
+        spans = _Scanner(html).scan()
+        if len(spans) != 1 or spans[0].html != html:
+            raise ValueError('Not a single sync span')
+        new = spans[0]
+        new.start, new.end = span.start, span.end
+        new.changed = True
+        self.spans[idx] = new
+        return new
+
+    def set_inner(self, span: Span, inner: str) -> Span:
+        tag = span.tag
+        if tag.endswith('/>'):
+            tag = tag[:-2].rstrip() + '>'
+        return self.replace(span, tag + inner + (span.close or '</span>'))
+
+    def set_attr(self, span: Span, name: str, value: str) -> Span:
+        attr = f'{name}="{html.escape(value, quote=True)}"'
+        if span.has_attr(name):
+            attrs = [f'{key}="{html.escape(val, quote=True)}"' if val is not None else key
+                     for key, val in span.attrs.items() if key != name]
+            tag = '<span ' + ' '.join(attrs + [attr]) + ('/>' if span.tag.endswith('/>') else '>')
+        else:
+            # Keep the original tag text, only append the attribute
+            end = len(span.tag) - (2 if span.tag.endswith('/>') else 1)
+            tag = span.tag[:end].rstrip() + f' {attr}' + span.tag[end:]
+        return self.replace(span, tag + span.inner + span.close)
+
+    def encode(self) -> str:
+        out = []
+        pos = 0
+        for span in self.spans:
+            if not span.changed:
+                continue
+            out.append(self.text[pos:span.start])
+            out.append(span.html)
+            pos = span.end
+        out.append(self.text[pos:])
+        return ''.join(out)
+
+
+@cache
+def _bs4():
+    # Slow to import and only needed by the fallback backend
+    import bs4
+    warnings.filterwarnings('ignore', category=bs4.MarkupResemblesLocatorWarning, module='bs4')
+    return bs4
+
+
+class SoupDocument(Document):
+    '''
+    Fallback backend built on BeautifulSoup. The whole field is re-encoded.
+    '''
+
+    def __init__(self, text: str):
+        self.text = text
+        self.soup = _bs4().BeautifulSoup(text, 'html.parser')
+        self.tags = self.soup.find_all('span', {'class': 'sync'}, recursive=False)
+        self.spans = [self.__span(tag) for tag in self.tags]
+
+    @staticmethod
+    def __span(tag) -> Span:
+        text = tag.decode(formatter='html5')
+        inner = tag.decode_contents(formatter='html5')
+        close = '</span>' if text.endswith('</span>') else ''
+        open_tag = text[:len(text) - len(inner) - len(close)]
+        return Span(open_tag, {key: ' '.join(val) if isinstance(val, list) else val
+                               for key, val in tag.attrs.items()}, inner, close)
+
+    def replace(self, span: Span, html: str) -> Span:
+        idx = self.spans.index(span)
+        tag = _bs4().BeautifulSoup(html, 'html.parser').find('span', {'class': 'sync'}, recursive=False)
+        if tag is None:
+            raise ValueError('Not a single sync span')
+        self.tags[idx].replace_with(tag)
+        self.tags[idx] = tag
+        self.spans[idx] = self.__span(tag)
+        self.spans[idx].changed = True
+        return self.spans[idx]
+
+    def encode(self) -> str:
+        return self.soup.encode(formatter='html5').decode('utf-8')
+
+
+BACKENDS = {
+    'tokenizer': Document,
+    'bs4': SoupDocument,
+}
+backend = 'tokenizer'
+
+
+def parse(text: str) -> Document:
+    return BACKENDS[backend](text)
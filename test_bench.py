@@ -0,0 +1,29 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from . import bench
+
+
+def test_run():
+    results = bench.run(notes=60, density=0.5, fanout=5, sample=5)
+
+    assert [result['case'] for result in results] == [
+        'build', 'unidir.sync_field', 'unidir.sync_all (cold)', 'unidir.sync_all (unchanged)',
+        'unidir.sync_all (one source changed)', 'bidir.index (cold)', 'bidir.are_spans_coherent',
+        'bidir.download', 'bidir.upload', 'bidir.generate_sid',
+    ]
+    for result in results:
+        assert result['notes'] == 60
+        assert result['seconds'] >= 0
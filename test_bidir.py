@@ -17,7 +17,8 @@ import re
 
 import pytest
 
-from . import bidir
+from . import bidir, documents, spans
+from . import index as note_index
 from .test_utils import get_empty_col, load_notes
 
 
@@ -183,6 +184,28 @@ def test_upload_single_card(col):
     assert n1['Front'] == '<span class="sync" sid="1">Content</span>'
 
 
+def test_upload_skips_unchanged(col, updated):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1">Original content</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" sid="1">New content</span>'
+    col.add_note(n2, 0)
+
+    n3 = col.new_note(basic)
+    n3['Front'] = '<span class="sync" sid="1">New content</span>'
+    col.add_note(n3, 0)
+
+    assert bidir.sync_field(col, n3, 0, MockPopup('Upload')) is True
+    load_notes((n1, n2))
+
+    assert n1['Front'] == '<span class="sync" sid="1">New content</span>'
+    assert updated == [[n1.id]]
+
+
 def test_no_change(col):
     basic = col.models.by_name('Basic')
 
@@ -276,6 +299,345 @@ def test_span_coherency_non_homogenous(col):
     assert bidir.are_spans_coherent(col, [n1.id, n2.id, n3.id], 1) is False
 
 
+def test_incoherent(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1">Original content</span><span class="sync" sid="2">Same</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" sid="1">New content</span>'
+    n2['Back'] = '<span class="sync" sid="2">Same</span>'
+    col.add_note(n2, 0)
+
+    n3 = col.new_note(basic)
+    n3['Front'] = '<span class="sync" sid="3">One</span><span class="sync" sid="3">Two</span>'
+    col.add_note(n3, 0)
+
+    incoherent = bidir.incoherent(col)
+    assert set(incoherent) == {'1', '3'}
+    assert sorted(incoherent['1']) == sorted([n1.id, n2.id])
+    assert incoherent['3'] == [n3.id]
+
+
+def test_incoherent_after_undo(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1">Original content</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" sid="1">Original content</span>'
+    col.add_note(n2, 0)
+
+    # Not modified in the second of a checkpoint, which would rescan them anyway
+    col.db.execute('update notes set mod = mod - 10')
+    assert bidir.incoherent(col) == {}
+
+    n1['Front'] = '<span class="sync" sid="1">New content</span>'
+    col.update_note(n1)
+    assert set(bidir.incoherent(col)) == {'1'}
+
+    # The undone note has an older mod than the last checkpoint
+    col.undo()
+    assert bidir.incoherent(col) == {}
+    assert bidir.are_spans_coherent(col, [n1.id, n2.id], 1) is True
+
+
+def test_upload_after_undo(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1">Original content</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" sid="1">New content</span>'
+    col.add_note(n2, 0)
+
+    col.db.execute('update notes set mod = mod - 10')
+    assert set(bidir.incoherent(col)) == {'1'}
+
+    n2['Front'] = '<span class="sync" sid="1">Original content</span>'
+    col.update_note(n2)
+    assert bidir.incoherent(col) == {}
+
+    col.undo()
+    span = spans.parse(n1['Front']).spans[0]
+    bidir.upload(col, [n2.id], span)
+    load_notes((n2,))
+
+    assert n2['Front'] == '<span class="sync" sid="1">Original content</span>'
+
+
+def test_sync_all(col, updated):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1">Old</span>'
+    n1['Back'] = '<span class="sync" sid="2">Shared</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" sid="1">New</span>'
+    n2['Back'] = '<span class="sync" sid="2"></span>'
+    col.add_note(n2, 0)
+
+    n3 = col.new_note(basic)
+    n3['Front'] = '<span class="sync" sid="1"></span>'
+    col.add_note(n3, 0)
+
+    # n2 is the most recent
+    col.db.execute('update notes set mod = mod - 10 where id != ?', n2.id)
+
+    chosen = []
+
+    def choose(sid, spans):
+        chosen.append((sid, [span.inner for span in spans]))
+        return bidir.newest(sid, spans)
+
+    assert bidir.sync_all(col, choose) == 3
+    load_notes((n1, n2, n3))
+
+    # Asked once for the sid with two versions, the empty reference is filled without asking
+    assert chosen == [('1', ['New', 'Old'])]
+    assert updated == [sorted((n1.id, n2.id, n3.id))]
+    assert n1['Front'] == '<span class="sync" sid="1">New</span>'
+    assert n2['Back'] == '<span class="sync" sid="2">Shared</span>'
+    assert n3['Front'] == '<span class="sync" sid="1">New</span>'
+    assert bidir.incoherent(col) == {}
+
+
+def test_sync_all_skip(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1">Old</span>'
+    n1['Back'] = '<span class="sync" sid="2">Shared</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" sid="1">New</span>'
+    n2['Back'] = '<span class="sync" sid="2"></span>'
+    col.add_note(n2, 0)
+
+    assert bidir.sync_all(col, bidir.skip) == 1
+    load_notes((n1, n2))
+    assert n1['Front'] == '<span class="sync" sid="1">Old</span>'
+    assert n2['Front'] == '<span class="sync" sid="1">New</span>'
+    assert n2['Back'] == '<span class="sync" sid="2">Shared</span>'
+    conflicts = bidir.conflicts(col)
+    assert list(conflicts) == ['1']
+    assert {span.inner for span in conflicts['1']} == {'Old', 'New'}
+
+
+def test_conflict_queue(col, updated):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1">Other</span><span class="sync" sid="2">Other</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" sid="1">Edited</span><span class="sync" sid="2">Edited</span>'
+    col.add_note(n2, 0)
+    col.db.execute('update notes set mod = mod - 10 where id = ?', n1.id)
+
+    queue = bidir.ConflictQueue()
+    assert bidir.sync_field(col, n2, 0, queue) is False
+    load_notes((n1, n2))
+    assert list(queue.sids) == ['1', '2']
+    assert n1['Front'] == '<span class="sync" sid="1">Other</span><span class="sync" sid="2">Other</span>'
+
+    conflicts = queue.take(col)
+    assert len(queue) == 0
+    assert {sid: [span.inner for span in spans] for sid, spans in conflicts.items()} == \
+        {'1': ['Edited', 'Other'], '2': ['Edited', 'Other']}
+
+    # Upload the first, download the second
+    out = bidir.resolve_op(col, {'1': conflicts['1'][0], '2': conflicts['2'][1]})
+    load_notes((n1, n2))
+    assert out.count == 2
+    assert updated == [sorted((n1.id, n2.id))]
+    assert n1['Front'] == '<span class="sync" sid="1">Edited</span><span class="sync" sid="2">Other</span>'
+    assert n2['Front'] == '<span class="sync" sid="1">Edited</span><span class="sync" sid="2">Other</span>'
+
+
+def test_resolve_edited_since_listed(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1">Other</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" sid="1">Edited</span>'
+    col.add_note(n2, 0)
+
+    conflicts = bidir.conflicts(col)
+    seen = {sid: {bidir.span_hash(span) for span in spans} for sid, spans in conflicts.items()}
+    other = next(span for span in conflicts['1'] if span.inner == 'Other')
+
+    n2['Front'] = '<span class="sync" sid="1">Edited again</span>'
+    col.update_note(n2)
+
+    queue = bidir.ConflictQueue()
+    out = bidir.resolve_op(col, {'1': other}, seen, queue)
+    load_notes((n1, n2))
+    assert out.count == 0
+    assert list(queue.sids) == ['1']
+    assert n2['Front'] == '<span class="sync" sid="1">Edited again</span>'
+
+    # Listed again with the current versions
+    conflicts = queue.take(col)
+    seen = {sid: {bidir.span_hash(span) for span in spans} for sid, spans in conflicts.items()}
+    assert {span.inner for span in conflicts['1']} == {'Other', 'Edited again'}
+    assert bidir.resolve_op(col, {'1': other}, seen).count == 1
+    load_notes((n1, n2))
+    assert n2['Front'] == '<span class="sync" sid="1">Other</span>'
+
+
+def test_three_way(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1">Base</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" sid="1">Base</span>'
+    col.add_note(n2, 0)
+
+    n3 = col.new_note(basic)
+    n3['Front'] = '<span class="sync" sid="1">Base</span>'
+    col.add_note(n3, 0)
+
+    index = bidir.BidirIndex.get(col)
+    index.refresh(col)
+    assert index.bases == {'1': bidir.content_hash('Base')}
+
+    popup = MockPopup('Upload')
+
+    # Only the other notes changed
+    n2['Front'] = n3['Front'] = '<span class="sync" sid="1">Theirs</span>'
+    col.update_notes([n2, n3])
+    assert bidir.sync_field(col, n1, 0, popup) is True
+    load_notes((n1,))
+    assert n1['Front'] == '<span class="sync" sid="1">Theirs</span>'
+
+    # Only this note changed
+    n1['Front'] = '<span class="sync" sid="1">Mine</span>'
+    col.update_note(n1)
+    assert bidir.sync_field(col, n1, 0, popup) is True
+    load_notes((n2, n3))
+    assert n2['Front'] == n3['Front'] == '<span class="sync" sid="1">Mine</span>'
+    assert popup.n_called == 0
+
+    # Both changed
+    n1['Front'] = '<span class="sync" sid="1">Mine again</span>'
+    n2['Front'] = '<span class="sync" sid="1">Theirs again</span>'
+    col.update_notes([n1, n2])
+    assert bidir.sync_field(col, n1, 0, popup) is True
+    assert popup.n_called == 1
+
+    # The base is persisted with the index
+    index.refresh(col)
+    index.save()
+    assert bidir.BidirIndex.load(index.path).bases == {'1': bidir.content_hash('Mine again')}
+
+
+def test_three_way_download_skips_references(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1">Base</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" sid="1"></span>'
+    col.add_note(n2, 0)
+
+    n3 = col.new_note(basic)
+    n3['Front'] = '<span class="sync" sid="1">Base</span>'
+    col.add_note(n3, 0)
+
+    index = bidir.BidirIndex.get(col)
+    index.refresh(col)
+
+    n3['Front'] = '<span class="sync" sid="1">Theirs</span>'
+    col.update_note(n3)
+
+    popup = MockPopup('Upload')
+    assert bidir.sync_field(col, n1, 0, popup) is True
+    load_notes((n1,))
+
+    assert popup.n_called == 0
+    assert n1['Front'] == '<span class="sync" sid="1">Theirs</span>'
+    assert index.bases['1'] == bidir.content_hash('Theirs')
+
+
+def test_sync_all_three_way(col):
+    basic = col.models.by_name('Basic')
+
+    notes = []
+    for sid in ('1', '1', '2', '2'):
+        note = col.new_note(basic)
+        note['Front'] = f'<span class="sync" sid="{sid}">Base</span>'
+        col.add_note(note, 0)
+        notes.append(note)
+    bidir.BidirIndex.get(col).refresh(col)
+
+    notes[0]['Front'] = '<span class="sync" sid="1">Changed</span>'
+    notes[2]['Front'] = '<span class="sync" sid="2">One</span>'
+    notes[3]['Front'] = '<span class="sync" sid="2">Two</span>'
+    col.update_notes(notes)
+
+    assert set(bidir.conflicts(col)) == {'2'}
+    assert bidir.sync_all(col, bidir.skip) == 1
+    load_notes(notes)
+    assert notes[1]['Front'] == '<span class="sync" sid="1">Changed</span>'
+    assert notes[2]['Front'] == '<span class="sync" sid="2">One</span>'
+
+
+def test_upload_splices(col, monkeypatch):
+    basic = col.models.by_name('Basic')
+
+    # Markup a parser would normalize stays as it is
+    prefix = '<DIV class=x>' + 'text&nbsp;' * 1000 + '</DIV><br>'
+    n1 = col.new_note(basic)
+    n1['Front'] = prefix + '<span class="sync" sid="1">Old</span><B >bold</B>' + '<span class="sync" sid="1">Old</span>'
+    col.add_note(n1, 0)
+    bidir.BidirIndex.get(col).refresh(col)
+
+    parsed = []
+    parse = documents.parse
+
+    def spy(text):
+        parsed.append(text)
+        return parse(text)
+    monkeypatch.setattr(documents, 'parse', spy)
+
+    span = spans.parse('<span class="sync" sid="1">New</span>').spans[0]
+    bidir.upload(col, [n1.id], span)
+    load_notes((n1,))
+
+    assert parsed == []
+    assert n1['Front'] == prefix + '<span class="sync" sid="1">New</span><B >bold</B>' + \
+        '<span class="sync" sid="1">New</span>'
+
+
+def test_splice_stale():
+    text = 'a <span class="sync" sid="1">Old</span> b'
+    located = [[bidir.content_hash('Old'), 2, 39]]
+    html = '<span class="sync" sid="1">New</span>'
+    assert bidir.splice(text, '1', located, html) == f'a {html} b'
+    assert bidir.splice('x' + text, '1', located, html) is None
+    assert bidir.splice(text.replace('Old', 'Odd'), '1', located, html) is None
+    assert bidir.splice(text, '2', located, html) is None
+
+
 def test_card_is_being_created(col):
     basic = col.models.by_name('Basic')
 
@@ -339,6 +701,136 @@ def test_id_missing_multiple_spans_in_note(col):
         f'<span class="sync" sid="{n1.id}_0_' + r'\d{4}' + '">Another</span>'
     ), n1['Front'])
 
+
+def test_id_missing_many_spans_unique(col, monkeypatch):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync">Content</span>' * 20
+    col.add_note(n1, 0)
+
+    def find_notes(*args, **kwargs):
+        raise AssertionError('find_notes called')
+    monkeypatch.setattr(col, 'find_notes', find_notes)
+
+    assert bidir.sync_field(col, n1, 0, MockPopup('Download')) is True
+    load_notes((n1,))
+
+    sids = re.findall(r'sid="(.*?)"', n1['Front'])
+    assert len(sids) == 20
+    assert len(set(sids)) == 20
+    assert all(re.fullmatch(f'{n1.id}_0_' + r'\d{4}', sid) for sid in sids)
+
+
+def test_sid_not_reused(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    col.add_note(n1, 0)
+
+    index = bidir.BidirIndex.get(col)
+    index.SID_SUFFIXES = 3
+    sids = bidir.generate_sids(col, n1, 0, 2)
+    n1['Front'] = ''.join(f'<span class="sync" sid="{sid}">Content</span>' for sid in sids)
+    col.update_note(n1)
+    index.allocated.clear()
+
+    assert bidir.generate_sids(col, n1, 0, 1)[0] not in sids
+    with pytest.raises(ValueError):
+        bidir.generate_sids(col, n1, 0, 1)
+
+
+def test_index_saved_once(col, monkeypatch):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1">Original content</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" sid="1">Original content</span>'
+    col.add_note(n2, 0)
+
+    saved = []
+    save = bidir.BidirIndex.save
+    monkeypatch.setattr(bidir.BidirIndex, 'save', lambda index: saved.append(index) or save(index))
+
+    for content in ('One', 'Two'):
+        n2['Front'] = f'<span class="sync" sid="1">{content}</span>'
+        col.update_note(n2)
+        assert bidir.sync_field(col, n2, 0, MockPopup('Upload')) is True
+    assert saved == []
+
+    index = bidir.BidirIndex.get(col)
+    assert index.unsaved is True
+    bidir.BidirIndex.save_all()
+    assert index in saved
+    assert index.unsaved is False
+    assert bidir.BidirIndex.load(index.path).notes.keys() == {n1.id, n2.id}
+
+
+def test_refresh_once(col, monkeypatch):
+    basic = col.models.by_name('Basic')
+
+    for sid in ('1', '2', '3'):
+        for content in ('One', 'Two'):
+            note = col.new_note(basic)
+            note['Front'] = f'<span class="sync" sid="{sid}">{content}</span>'
+            col.add_note(note, 0)
+
+    refreshes = []
+    refresh = bidir.BidirIndex.refresh
+    monkeypatch.setattr(bidir.BidirIndex, 'refresh', lambda index, col: refreshes.append(index) or refresh(index, col))
+
+    assert bidir.sync_all(col) == 3
+    assert len(refreshes) == 1
+    assert bidir.incoherent(col) == {}
+
+    # Without changes since the last refresh, indexed notes are not looked up again
+    def ids2str(*args):
+        raise AssertionError('ids2str called')
+    monkeypatch.setattr(note_index, 'ids2str', ids2str)
+    assert bidir.incoherent(col) == {}
+
+
+def test_no_search_once_indexed(col, monkeypatch):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1">Original content</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Back'] = '<span class="sync" sid="1">New content</span>'
+    col.add_note(n2, 0)
+
+    def find_notes(*args, **kwargs):
+        raise AssertionError('find_notes called')
+    monkeypatch.setattr(col, 'find_notes', find_notes)
+
+    assert bidir.sync_field(col, n2, 1, MockPopup('Upload')) is True
+    load_notes((n1, n2))
+
+    assert n1['Front'] == '<span class="sync" sid="1">New content</span>'
+    assert bidir.sync_field(col, n2, 1, MockPopup('Upload')) is False
+
+
+def test_coherent_markup(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1"><b>Bold</b> content</span>'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = '<span class="sync" sid="1"><b>Bold</b> content</span>'
+    col.add_note(n2, 0)
+
+    popup = MockPopup('Download')
+
+    assert bidir.sync_field(col, n2, 0, popup) is False
+    assert popup.n_called == 0
+
 # TODO
 # def test_nested_spans():
 #     pass
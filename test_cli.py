@@ -0,0 +1,115 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+import os
+import subprocess
+import sys
+
+import pytest
+from anki.collection import Collection
+
+from . import cli, instrument
+from .test_utils import get_empty_col, load_notes
+
+
+@pytest.fixture
+def col():
+    return get_empty_col()
+
+
+def add_notes(col: Collection):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    n2['Back'] = '<span class="sync" sid="1">Original content</span>'
+    col.add_note(n2, 0)
+
+    n3 = col.new_note(basic)
+    n3['Front'] = '<span class="sync" sid="1">New content</span>'
+    col.add_note(n3, 0)
+    return n1, n2, n3
+
+
+def test_sync(col):
+    n1, n2, n3 = add_notes(col)
+
+    report = cli.sync(col)
+    load_notes((n2,))
+
+    assert report.updated == 1
+    assert report.reconciled == 0
+    assert set(report.incoherent) == {'1'}
+    assert sorted(report.incoherent['1']) == sorted([n2.id, n3.id])
+    assert set(report.seconds) == {'unidir', 'bidir'}
+    assert n2['Front'] == f'<span class="sync" note="{n1.id}">\n<div>one</div>\n</span>'
+
+
+def test_main(col, monkeypatch, capsys):
+    n1, n2, n3 = add_notes(col)
+    path = col.path
+    col.close(downgrade=False)
+
+    # main turns timings on, restore them after the test
+    monkeypatch.setattr(instrument, 'enabled', False)
+    monkeypatch.setattr(instrument, 'stats', instrument.Stats())
+    monkeypatch.setattr(sys, 'argv', ['cli', path, '--quiet', '--timings'])
+    cli.main()
+    out = capsys.readouterr().out
+    assert out.startswith('1 notes updated\n0 notes reconciled\n1 incoherent sids\n')
+    assert 'sync_all.render' in out
+
+    col = Collection(path)
+    assert col.get_note(n2.id)['Front'] == f'<span class="sync" note="{n1.id}">\n<div>one</div>\n</span>'
+    col.close(downgrade=False)
+
+
+def test_sync_newest(col):
+    n1, n2, n3 = add_notes(col)
+    col.db.execute('update notes set mod = mod - 10 where id != ?', n3.id)
+
+    report = cli.sync(col, choose=cli.bidir.newest)
+    load_notes((n2,))
+
+    assert report.updated == 1
+    assert report.reconciled == 1
+    assert report.incoherent == {}
+    assert n2['Back'] == '<span class="sync" sid="1">New content</span>'
+
+
+# Servers without GUI libraries fail to import aqt
+NO_GUI_SCRIPT = '''
+import importlib, sys
+
+class NoGui:
+    def find_spec(self, name, path, target=None):
+        if name.split('.')[0] == 'aqt':
+            raise ImportError(name)
+
+sys.meta_path.insert(0, NoGui())
+importlib.import_module(sys.argv[1])
+'''
+
+
+def test_no_gui_imports():
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    subprocess.run([sys.executable, '-c', NO_GUI_SCRIPT, f'{os.path.basename(package_dir)}.cli'],
+                   cwd=os.path.dirname(package_dir), check=True)
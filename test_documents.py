@@ -0,0 +1,143 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from . import bidir, documents, unidir
+from .documents import Documents
+from .test_utils import get_empty_col, load_notes
+
+
+@pytest.fixture
+def col():
+    return get_empty_col()
+
+
+def test_parse_once(col, monkeypatch, updated):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span><span class="sync">Content</span>'
+    col.add_note(n2, 0)
+
+    parsed = []
+    parse = documents.parse
+
+    def spy(text):
+        parsed.append(text)
+        return parse(text)
+    monkeypatch.setattr(documents, 'parse', spy)
+
+    docs = Documents()
+    assert unidir.sync_field(col, n2, 0, docs) is True
+    assert bidir.sync_field(col, n2, 0, docs=docs) is True
+    assert docs.flush(col) == {n2.id}
+    load_notes((n2,))
+
+    assert parsed == [f'<span class="sync" note="{n1.id}"></span><span class="sync">Content</span>']
+    assert updated == [[n2.id]]
+    assert n2['Front'].startswith(f'<span class="sync" note="{n1.id}">\n<div>one</div>\n</span><span class="sync" sid=')
+
+
+def test_reparse_changed_field(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'one'
+    col.add_note(n1, 0)
+
+    docs = Documents()
+    bs = docs.get(n1, 0)
+    assert docs.get(n1, 0) is bs
+
+    n1['Front'] = 'two'
+    assert docs.get(n1, 0) is not bs
+    assert docs.get(n1, 0).text == 'two'
+
+
+@pytest.mark.parametrize('fast_load', [True, False])
+def test_get_notes(col, monkeypatch, fast_load):
+    monkeypatch.setattr(documents, 'FAST_LOAD', fast_load)
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'one'
+    n1.tags = ['a', 'b']
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(cloze)
+    n2['Text'] = '{{c1::two}}'
+    col.add_note(n2, 0)
+
+    notes = documents.get_notes(col, [n1.id, n2.id, 1234])
+    load_notes((n1, n2))
+
+    assert set(notes) == {n1.id, n2.id}
+    for note in (n1, n2):
+        other = notes[note.id]
+        assert (other.guid, other.mid, other.mod, other.usn, other.tags, other.fields) == \
+            (note.guid, note.mid, note.mod, note.usn, note.tags, note.fields)
+    assert notes[n2.id]['Text'] == '{{c1::two}}'
+
+
+def test_fast_load_version():
+    # Update the checked versions after testing get_notes with a new Anki release
+    assert documents.FAST_LOAD is True
+
+
+def test_flush_single_update(col, updated):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    dependents = []
+    for _ in range(3):
+        note = col.new_note(basic)
+        note['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+        col.add_note(note, 0)
+        dependents.append(note)
+
+    assert unidir.sync_all(col) == 3
+    load_notes(dependents)
+
+    assert updated == [sorted(note.id for note in dependents)]
+    for note in dependents:
+        assert note['Front'] == f'<span class="sync" note="{n1.id}">\n<div>one</div>\n</span>'
+
+
+def test_flush_skips_unchanged(col, updated):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = '<span class="sync" sid="1">one</span>'
+    col.add_note(n1, 0)
+
+    docs = Documents()
+    doc = docs.get(n1, 0)
+    doc.set_inner(doc.spans[0], 'one')
+    docs.mark_changed(n1, 0)
+    docs.update(n1, 1, '')
+
+    assert docs.flush(col) == set()
+    assert updated == []
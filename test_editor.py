@@ -0,0 +1,167 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from . import editor, unidir
+from .bidir import BidirIndex
+from .test_utils import get_empty_col, load_notes
+
+
+@pytest.fixture
+def col():
+    return get_empty_col()
+
+
+class MockPopup():
+    def __init__(self, return_value: str):
+        self.return_value = return_value
+        self.calls = []
+
+    def __call__(self, sid):
+        self.calls.append(sid)
+        return self.return_value
+
+
+@pytest.fixture
+def linked(col):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = (f'Text <span class="sync" note="{n1.id}">\n<div>one</div>\n</span>'
+                   '<span class="sync" sid="1">Shared</span>')
+    col.add_note(n2, 0)
+
+    n3 = col.new_note(basic)
+    n3['Front'] = '<span class="sync" sid="1">Shared</span>'
+    col.add_note(n3, 0)
+    return n1, n2, n3
+
+
+def test_text_outside_spans(col, linked, monkeypatch):
+    n1, n2, n3 = linked
+    editor.on_focus(n2, 0)
+    n2['Front'] = n2['Front'].replace('Text', 'Edited text')
+
+    refreshed = []
+    monkeypatch.setattr(BidirIndex, 'refresh', lambda index, col: refreshed.append(index))
+    monkeypatch.setattr(unidir, 'render_span', lambda *args: pytest.fail('rendered'))
+
+    popup = MockPopup('Upload')
+    assert editor.sync_field(col, n2, 0, popup) is False
+    assert popup.calls == []
+    assert refreshed == []
+
+
+def test_edited_spans(col, linked):
+    n1, n2, n3 = linked
+    editor.on_focus(n2, 0)
+    n2['Front'] = n2['Front'].replace('<div>one</div>', 'broken').replace('Shared', 'Changed')
+
+    popup = MockPopup('Download')
+    assert editor.sync_field(col, n2, 0, popup) is True
+    load_notes((n2, n3))
+
+    # Only this note changed since the spans were the same, uploaded without asking
+    assert popup.calls == []
+    assert n2['Front'] == (f'Text <span class="sync" note="{n1.id}">\n<div>one</div>\n</span>'
+                           '<span class="sync" sid="1">Changed</span>')
+    assert n3['Front'] == '<span class="sync" sid="1">Changed</span>'
+
+
+def test_without_snapshot(col, linked):
+    n1, n2, n3 = linked
+    n3['Front'] = '<span class="sync" sid="1">Changed</span>'
+    col.update_note(n3)
+
+    # Not focused, everything is checked
+    popup = MockPopup('Download')
+    assert editor.sync_field(col, n2, 0, popup) is True
+    load_notes((n2,))
+    assert popup.calls == ['1']
+    assert n2['Front'].endswith('<span class="sync" sid="1">Changed</span>')
+
+
+def test_queue_coalesces(col, linked, updated):
+    n1, n2, n3 = linked
+    # The editor saves a field before its unfocus hook runs
+    editor.on_focus(n2, 0)
+    n2['Front'] = n2['Front'].replace('<div>one</div>', 'broken')
+    col.update_note(n2)
+    editor.on_focus(n3, 0)
+    n3['Front'] = '<span class="sync" sid="1">Changed</span>'
+    col.update_note(n3)
+
+    queue = editor.SyncQueue()
+    queue.add(n2, 0)
+    queue.add(n3, 0)
+    # The snapshot is kept while the sync is pending, refocusing does not replace it
+    editor.on_focus(n3, 0)
+    queue.add(n3, 0)
+    queue.add(n3, 1)
+    assert queue.pending == {n2.id: {0}, n3.id: {0, 1}}
+
+    updated.clear()
+    popup = MockPopup('Upload')
+    # Both the render in n2 and the upload from n3 are saved in a single update of n2
+    assert queue.flush(col, popup) == {n2.id}
+    assert queue.pending == {}
+    assert updated == [[n2.id]]
+    assert popup.calls == ['1']
+
+    load_notes((n2,))
+    assert n2['Front'] == (f'Text <span class="sync" note="{n1.id}">\n<div>one</div>\n</span>'
+                           '<span class="sync" sid="1">Changed</span>')
+
+
+def test_queue_loads_saved_notes(col, linked):
+    n1, n2, n3 = linked
+    queue = editor.SyncQueue()
+    # The object given to the hook may be older than the note the editor saved
+    stale = col.get_note(n2.id)
+    n2['Front'] = n2['Front'].replace('<div>one</div>', 'broken')
+    col.update_note(n2)
+    queue.add(stale, 0)
+
+    new = col.new_note(col.models.by_name('Basic'))
+    queue.add(new, 0)
+    assert queue.pending == {n2.id: {0}}
+
+    assert queue.flush(col, MockPopup('Upload')) == {n2.id}
+    load_notes((n2,))
+    assert n2['Front'].startswith(f'Text <span class="sync" note="{n1.id}">\n<div>one</div>\n</span>')
+    assert queue.flush(col, MockPopup('Upload')) == set()
+
+
+def test_queue_syncs_shown_note(col, linked):
+    n1, n2, n3 = linked
+    n2['Front'] = n2['Front'].replace('<div>one</div>', 'broken')
+    col.update_note(n2)
+
+    queue = editor.SyncQueue()
+    queue.add(n2, 0)
+    # The object of the editor showing the note, which saves it again later
+    shown = col.get_note(n2.id)
+    assert editor.sync_pending(col, queue.take(), MockPopup('Upload'), {n2.id: shown}) == {n2.id}
+    assert shown['Front'].startswith(f'Text <span class="sync" note="{n1.id}">\n<div>one</div>\n</span>')
+
+    col.update_note(shown)
+    load_notes((n2,))
+    assert n2['Front'] == shown['Front']
@@ -0,0 +1,38 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from .graph import strongly_connected
+
+
+def components(graph: dict[int, list[int]]) -> list[set[int]]:
+    return [set(c) for c in strongly_connected(graph, lambda node: graph.get(node, []))]
+
+
+def test_chain_dependencies_first():
+    assert components({1: [2], 2: [3], 3: []}) == [{3}, {2}, {1}]
+
+
+def test_cycle():
+    assert components({1: [2], 2: [3], 3: [1], 4: [1]}) == [{1, 2, 3}, {4}]
+
+
+def test_self_loop():
+    assert components({1: [1]}) == [{1}]
+
+
+def test_deep_chain():
+    graph = {i: [i + 1] for i in range(10000)}
+    assert components(graph)[0] == {10000}
+    assert components(graph)[-1] == {0}
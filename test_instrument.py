@@ -0,0 +1,96 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from . import editor, instrument, unidir
+from .test_utils import get_empty_col
+
+
+@pytest.fixture
+def col():
+    return get_empty_col()
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    stats = instrument.Stats()
+    monkeypatch.setattr(instrument, 'stats', stats)
+    monkeypatch.setattr(instrument, 'enabled', True)
+    return stats
+
+
+def test_disabled(monkeypatch):
+    stats = instrument.Stats()
+    monkeypatch.setattr(instrument, 'stats', stats)
+
+    with instrument.phase('parse'):
+        pass
+    instrument.count('render.cached')
+    assert stats.counts == {}
+
+
+def test_phases(stats):
+    for sid in ('1', '1', '2'):
+        with instrument.phase('bidir.upload', sid):
+            pass
+    assert stats.counts == {('bidir.upload', '1'): 2, ('bidir.upload', '2'): 1}
+    assert 'bidir.upload [1]' in stats.summary()
+
+
+def test_sync_all(col, stats):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    for _ in range(2):
+        note = col.new_note(basic)
+        note['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+        col.add_note(note, 0)
+
+    unidir.render_cache.clear()
+    assert unidir.sync_all(col) == 2
+    assert stats.counts[('render', 'Cloze')] == 1
+    assert stats.counts[('render.cached', 'Cloze')] == 1
+    for name in ('index.unidir', 'sync_all.plan', 'sync_all.render', 'load', 'save'):
+        assert stats.counts[(name, None)] >= 1
+
+
+def test_editor_per_note_type(col, stats):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    queue = editor.SyncQueue()
+    queue.add(n2, 0)
+    queue.add(n2, 1)
+    assert queue.flush(col) == {n2.id}
+    assert stats.counts[('editor', 'Basic')] == 2
+
+
+def test_profile():
+    out, profiler = instrument.profile(sum, [1, 2])
+    assert out == 3
+    assert 'sum' in instrument.profile_summary(profiler)
@@ -0,0 +1,140 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from . import spans
+
+
+@pytest.mark.parametrize('field', [
+    '<span class="sync" note="1"></span>',
+    '<span sid="1" class="sync">Content</span>',
+    "<SPAN class='foo sync'>Content</SPAN>",
+    '<span class=sync>Content</span>',
+    'Before <span class="sync"/> after',
+    '<span title="a>b" class="sync" sid="1">Content</span>',
+    "<span data-x='>' class=\"sync\">Content</span>",
+])
+def test_has_sync_spans(field):
+    assert spans.has_sync_spans(field) is True
+    assert len(spans.Document(field).spans) == 1
+
+
+@pytest.mark.parametrize('field', [
+    '',
+    'Plain text about syncing',
+    '<span note="1"></span>',
+    '<div class="sync">Content</div>',
+    '<span class="other">sync</span>',
+])
+def test_has_no_sync_spans(field):
+    assert spans.has_sync_spans(field) is False
+
+
+def test_offsets():
+    field = (
+        'Before '
+        '<span class="sync" sid="1">A <span>nested</span> B</span>'
+        ' middle '
+        '<span class="sync" note="2"><span class="sync" sid="3"></span></span>'
+        ' after'
+    )
+    doc = spans.Document(field)
+
+    assert [field[span.start:span.end] for span in doc.spans] == [
+        '<span class="sync" sid="1">A <span>nested</span> B</span>',
+        '<span class="sync" note="2"><span class="sync" sid="3"></span></span>',
+    ]
+    assert [span.inner for span in doc.spans] == [
+        'A <span>nested</span> B',
+        '<span class="sync" sid="3"></span>',
+    ]
+
+
+def test_offsets_unclosed():
+    field = 'Before <span class="sync" sid="1">Content'
+    doc = spans.Document(field)
+
+    assert [(span.start, span.end, span.inner) for span in doc.spans] == [(7, len(field), 'Content')]
+
+
+@pytest.mark.parametrize('backend', spans.BACKENDS.values())
+def test_top_level_only(backend):
+    doc = backend(
+        '<span class="sync" sid="1">One</span><br>'
+        '<div><span class="sync" sid="2">Two</span></div>'
+        '<p>Unclosed <span class="sync" sid="3">Three</span>'
+    )
+
+    assert [span.get('sid') for span in doc.spans] == ['1']
+
+
+@pytest.mark.parametrize('backend', spans.BACKENDS.values())
+def test_find(backend):
+    doc = backend(
+        '<span class="sync" sid="1">One</span>'
+        '<span class="sync" note="2"></span>'
+        '<span class="sync">Three</span>'
+    )
+
+    assert [span.inner for span in doc.find(sid=True)] == ['One']
+    assert [span.inner for span in doc.find(sid='1')] == ['One']
+    assert [span.get('note') for span in doc.find(note=True)] == ['2']
+    assert [span.inner for span in doc.find(note=False, sid=False)] == ['Three']
+
+
+def test_splice_keeps_other_markup():
+    field = (
+        "<div class='x'>caf\xe9&nbsp;<br/></div>"
+        '<span class="sync" note="1"></span>'
+        '<span   class="sync" sid="2">Old</span>'
+        '<span class="sync"/>'
+    )
+    doc = spans.Document(field)
+    doc.set_inner(doc.spans[0], '<div>New</div>')
+    doc.replace(doc.spans[1], '<span class="sync" sid="2">Other</span>')
+    doc.set_attr(doc.spans[2], 'sid', '3')
+
+    assert doc.encode() == (
+        "<div class='x'>caf\xe9&nbsp;<br/></div>"
+        '<span class="sync" note="1"><div>New</div></span>'
+        '<span class="sync" sid="2">Other</span>'
+        '<span class="sync" sid="3"/>'
+    )
+
+
+def test_unchanged_document():
+    field = "<SPAN class='sync' sid=1>Content</SPAN> <b>bold"
+
+    assert spans.Document(field).encode() == field
+
+
+def test_replace_requires_single_span():
+    doc = spans.Document('<span class="sync" sid="1">Content</span>')
+
+    with pytest.raises(ValueError):
+        doc.replace(doc.spans[0], '<div>Content</div>')
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('a &amp; b<br><!-- c --><div>d</div>', 'a &amp; b<br><!-- c --><div>d</div>'),
+    ('a</span>b', 'ab'),
+    ('<div>a</span></div>', '<div>a</div>'),
+    ('x<span>y', 'x<span>y</span>'),
+])
+def test_balance(text, expected):
+    assert spans.balance(text) == expected
+    doc = spans.Document('<span class="sync"></span>')
+    doc.set_inner(doc.spans[0], spans.balance(text))
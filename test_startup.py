@@ -0,0 +1,46 @@
+# Copyright (C) 2024 Jiří Szkandera
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import subprocess
+import sys
+
+from . import STARTUP_BUDGET
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Run in a fresh interpreter with Anki loaded already, as it is when add-ons are imported
+SCRIPT = '''
+import gc, importlib, json, sys, time
+import anki.collection, aqt, aqt.errors, aqt.operations, aqt.qt, aqt.utils
+# A full collection owed to the objects allocated by Anki would otherwise be timed as part of the add-on
+gc.collect()
+before = set(sys.modules)
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+print(json.dumps({'seconds': time.perf_counter() - start, 'modules': sorted(set(sys.modules) - before)}))
+'''
+
+
+def test_startup():
+    name = os.path.basename(PACKAGE_DIR)
+    out = subprocess.run([sys.executable, '-c', SCRIPT, name], cwd=os.path.dirname(PACKAGE_DIR),
+                         capture_output=True, text=True, check=True).stdout
+    result = json.loads(out)
+
+    for module in ('bs4', f'{name}.unidir', f'{name}.bidir', f'{name}.spans', 'multiprocessing', 'cProfile'):
+        assert module not in result['modules']
+    assert result['seconds'] < STARTUP_BUDGET
@@ -14,6 +14,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
+import sys
 from typing import Sequence
 
 import pytest
@@ -118,6 +119,30 @@ def test_nbsp(col):
     assert n2['Front'] == f'<span class="sync" note="{n1.id}">\n<div>one&nbsp;two</div>\n</span>'
 
 
+def test_stray_end_tag(col):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::a</span>b}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    n3 = col.new_note(basic)
+    n3['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n3, 0)
+
+    assert unidir.sync_field(col, n2, 0) is True
+    assert unidir.sync_all(col) == 1
+    load_notes((n2, n3))
+
+    assert n2['Front'] == f'<span class="sync" note="{n1.id}">\n<div>ab</div>\n</span>'
+    assert n3['Front'] == n2['Front']
+
+
 def test_changed(col):
     basic = col.models.by_name('Basic')
     cloze = col.models.by_name('Cloze')
@@ -445,3 +470,511 @@ def test_cycles(col):
 
     assert n1['Text'] == f'Before1 <span class="sync" note="{n2.id}"><div>Cycle detected</div></span> After1'
     assert n2['Text'] == f'Before2 <span class="sync" note="{n1.id}"><div>Cycle detected</div></span> After2'
+
+
+class RenderSpy():
+    def __init__(self, monkeypatch):
+        self.calls = []
+        render_note = unidir.render_note
+
+        def spy(this_id, fields, *args):
+            self.calls.extend((this_id, field_idx) for field_idx in fields)
+            return render_note(this_id, fields, *args)
+        monkeypatch.setattr(unidir, 'render_note', spy)
+
+
+def test_sync_all(col):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    assert unidir.sync_all(col) == 1
+    load_notes((n1, n2))
+
+    assert n2['Front'] == f'<span class="sync" note="{n1.id}">\n<div>one</div>\n</span>'
+
+
+def test_sync_all_only_dependents_of_modified(col, monkeypatch):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    n3 = col.new_note(cloze)
+    n3['Text'] = '{{c1::three}}'
+    col.add_note(n3, 0)
+
+    n4 = col.new_note(basic)
+    n4['Back'] = f'<span class="sync" note="{n3.id}"></span>'
+    col.add_note(n4, 0)
+
+    assert unidir.sync_all(col) == 2
+    # Pretend all notes were modified long before the last run
+    col.db.execute('update notes set mod = 0')
+    index = unidir.UnidirIndex.get(col)
+    index.mods = {src: 0 for src in index.mods}
+    index.scanned = {nid: 0 for nid in index.scanned}
+    index.written = {nid: 0 for nid in index.written}
+
+    spy = RenderSpy(monkeypatch)
+    assert unidir.sync_all(col) == 0
+    assert spy.calls == []
+
+    n1['Text'] = '{{c1::two}}'
+    col.update_note(n1)
+    assert unidir.sync_all(col) == 1
+    assert spy.calls == [(n2.id, 0)]
+    load_notes((n2, n4))
+
+    assert n2['Front'] == f'<span class="sync" note="{n1.id}">\n<div>two</div>\n</span>'
+    assert n4['Back'] == f'<span class="sync" note="{n3.id}">\n<div>three</div>\n</span>'
+
+
+def test_sync_all_deleted_source(col):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    assert unidir.sync_all(col) == 1
+    col.remove_notes([n1.id])
+    assert unidir.sync_all(col) == 1
+    load_notes((n2,))
+
+    assert n2['Front'] == f'<span class="sync" note="{n1.id}"><div>Invalid note ID</div></span>'
+
+
+@pytest.fixture
+def templates(tmp_path, monkeypatch):
+    registry = unidir.TemplateRegistry(str(tmp_path))
+    monkeypatch.setattr(unidir.Fetcher, 'templates', registry)
+    return registry
+
+
+@pytest.fixture
+def conditional(col, templates):
+    models = col.models
+    model = models.new('Conditional')
+    models.add_field(model, models.new_field('Front'))
+    models.add_field(model, models.new_field('Back'))
+    template = models.new_template('Template 1')
+    template["qfmt"] += '{{Front}}'
+    template["afmt"] += '{{Back}}'
+    models.add_template(model, template)
+    models.add_dict(model)
+
+    with open(os.path.join(templates.directory, 'Conditional.html'), 'w') as f:
+        f.write('<div>{{Front:cloze}}</div>{{#Back}}<div>{{Back}}</div>{{/Back}}')
+    return col.models.by_name('Conditional')
+
+
+@pytest.mark.parametrize('back, expected', [
+    ('', '\n<div>one</div>'),
+    ("<b class='x'>two</b><br/>", "\n<div>one</div><div><b class='x'>two</b><br/></div>"),
+])
+def test_fetch_conditional(col, conditional, back, expected):
+    n1 = col.new_note(conditional)
+    n1['Front'] = '{{c1::one}}'
+    n1['Back'] = back
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(col.models.by_name('Basic'))
+    col.add_note(n2, 0)
+
+    assert unidir.Fetcher(n2, n1).fetch() == expected
+
+
+def test_fetch_cycle(col, conditional):
+    n2 = col.new_note(col.models.by_name('Basic'))
+    col.add_note(n2, 0)
+
+    n1 = col.new_note(conditional)
+    n1['Front'] = f'<span class="sync" note="{n2.id}"></span>'
+    col.add_note(n1, 0)
+
+    with pytest.raises(ValueError, match='Cycle detected'):
+        unidir.Fetcher(n2, n1).fetch()
+
+
+def test_template_reload(col, templates, monkeypatch):
+    cloze = col.models.by_name('Cloze')
+    path = os.path.join(templates.directory, 'Cloze.html')
+    now = 0.0
+    monkeypatch.setattr(unidir.time, 'monotonic', lambda: now)
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    with pytest.raises(ValueError, match='Unknown model'):
+        unidir.Fetcher(n1, n1)
+
+    with open(path, 'w') as f:
+        f.write('<div>{{Text:cloze}}</div>')
+    # The miss is cached until the next check
+    with pytest.raises(ValueError, match='Unknown model'):
+        unidir.Fetcher(n1, n1)
+
+    now += templates.CHECK_INTERVAL
+    assert unidir.Fetcher(n1, n1).fetch() == '\n<div>one</div>'
+
+    with open(path, 'w') as f:
+        f.write('<p>{{Text:cloze}}</p>')
+    now += templates.CHECK_INTERVAL
+    assert unidir.Fetcher(n1, n1).fetch() == '\n<p>one</p>'
+
+
+def test_sync_all_template_edited(col, templates, monkeypatch):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+    path = os.path.join(templates.directory, 'Cloze.html')
+    now = 0.0
+    monkeypatch.setattr(unidir.time, 'monotonic', lambda: now)
+
+    with open(path, 'w') as f:
+        f.write('<div>{{Text:cloze}}</div>')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    col.db.execute('update notes set mod = mod - 10')
+    assert unidir.sync_all(col) == 1
+
+    with open(path, 'w') as f:
+        f.write('<p>Edited {{Text:cloze}}</p>')
+    now += templates.CHECK_INTERVAL
+    assert unidir.sync_all(col) == 1
+    load_notes((n2,))
+    assert n2['Front'] == f'<span class="sync" note="{n1.id}">\n<p>Edited one</p></span>'
+
+    now += templates.CHECK_INTERVAL
+    assert unidir.sync_all(col) == 0
+
+
+def test_sync_all_single_undo_entry(col):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    n3 = col.new_note(basic)
+    n3['Back'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n3, 0)
+
+    out = unidir.sync_all_op(col)
+
+    assert out.count == 2
+    assert out.changes.note_text is True
+    assert col.undo_status().undo == unidir.UNDO_SYNC_ALL
+
+    col.undo()
+    load_notes((n2, n3))
+
+    assert n2['Front'] == f'<span class="sync" note="{n1.id}"></span>'
+    assert n3['Back'] == f'<span class="sync" note="{n1.id}"></span>'
+
+
+def test_sync_all_after_undo(col):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    # Not modified in the second of a checkpoint, which would rescan them anyway
+    col.db.execute('update notes set mod = mod - 10')
+    assert unidir.sync_all(col) == 1
+
+    n1.load()
+    n1['Text'] = '{{c1::two}}'
+    col.update_note(n1)
+    col.db.execute('update notes set mod = mod - 5')
+    assert unidir.sync_all(col) == 1
+
+    # The undone render has an older mod than the last checkpoint
+    assert col.undo_status().undo == unidir.UNDO_SYNC_ALL
+    col.undo()
+    load_notes((n2,))
+    assert n2['Front'] == f'<span class="sync" note="{n1.id}">\n<div>one</div>\n</span>'
+
+    assert unidir.sync_all(col) == 1
+    load_notes((n2,))
+    assert n2['Front'] == f'<span class="sync" note="{n1.id}">\n<div>two</div>\n</span>'
+
+
+def test_sync_all_no_undo_entry_without_changes(col):
+    basic = col.models.by_name('Basic')
+
+    n1 = col.new_note(basic)
+    n1['Front'] = 'one'
+    col.add_note(n1, 0)
+
+    undo = col.undo_status().undo
+    assert unidir.sync_all(col) == 0
+    assert col.undo_status().undo == undo
+
+
+def test_sync_all_progress(col):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    calls = []
+
+    def progress(done: int, total: int) -> bool:
+        calls.append((done, total))
+        return True
+
+    assert unidir.sync_all_op(col, progress).count == 1
+    assert calls[0] == (0, 1)
+
+
+def test_sync_all_cancel(col):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    with pytest.raises(unidir.Cancelled):
+        unidir.sync_all_op(col, lambda done, total: False)
+    load_notes((n2,))
+    assert n2['Front'] == f'<span class="sync" note="{n1.id}"></span>'
+
+    # Notes skipped by the cancelled run are rendered by the next one
+    assert unidir.sync_all(col) == 1
+    load_notes((n2,))
+    assert n2['Front'] == f'<span class="sync" note="{n1.id}">\n<div>one</div>\n</span>'
+
+
+def test_sync_all_failure(col, monkeypatch):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    # Not modified in the second of the checkpoint, which would rescan them anyway
+    col.db.execute('update notes set mod = mod - 10')
+
+    def fail(*args):
+        raise RuntimeError('render failed')
+    with monkeypatch.context() as m:
+        m.setattr(unidir, 'render_note', fail)
+        with pytest.raises(RuntimeError):
+            unidir.sync_all_op(col)
+
+    # Not only a cancel, any failure leaves the notes for the next run
+    assert unidir.sync_all(col) == 1
+    load_notes((n2,))
+    assert n2['Front'] == f'<span class="sync" note="{n1.id}">\n<div>one</div>\n</span>'
+
+
+def test_sync_all_parallel(col, monkeypatch):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    notes = []
+    for i in range(5):
+        note = col.new_note(basic)
+        note['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+        note['Back'] = f'{i}<span class="sync" note="{n1.id}"></span><span class="sync" note="1"></span>'
+        col.add_note(note, 0)
+        notes.append(note)
+
+    monkeypatch.setattr(unidir, 'PARALLEL_MIN_NOTES', 0)
+    monkeypatch.setattr(unidir, 'CHUNK_SIZE', 2)
+    monkeypatch.setattr(unidir.os, 'cpu_count', lambda: 2)
+    assert unidir.sync_all(col) == 5
+    load_notes(notes)
+
+    for i, note in enumerate(notes):
+        assert note['Front'] == f'<span class="sync" note="{n1.id}">\n<div>one</div>\n</span>'
+        assert note['Back'] == (f'{i}<span class="sync" note="{n1.id}">\n<div>one</div>\n</span>'
+                                '<span class="sync" note="1"><div>Invalid note ID</div></span>')
+
+
+def test_in_process_inside_anki(col, monkeypatch):
+    monkeypatch.setattr(unidir.os, 'cpu_count', lambda: 2)
+    monkeypatch.setitem(sys.modules, 'aqt', object())
+    assert unidir._pool() is None
+
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    monkeypatch.setattr(unidir, 'PARALLEL_MIN_NOTES', 0)
+    assert unidir.sync_all(col) == 1
+    load_notes((n2,))
+    assert n2['Front'] == f'<span class="sync" note="{n1.id}">\n<div>one</div>\n</span>'
+
+
+def test_sync_all_chain(col, monkeypatch):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    n2 = col.new_note(basic)
+    n2['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    col.add_note(n2, 0)
+
+    n3 = col.new_note(basic)
+    n3['Front'] = f'<span class="sync" note="{n2.id}"></span>'
+    col.add_note(n3, 0)
+
+    # Rendered in a single pass even though n3 comes first
+    col.db.execute('update notes set id = 1 where id = ?', n3.id)
+    n3.id = 1
+
+    assert unidir.sync_all(col) == 2
+    load_notes((n2, n3))
+    assert n2['Front'] == f'<span class="sync" note="{n1.id}">\n<div>one</div>\n</span>'
+    assert n2['Front'] in n3['Front']
+
+    # Pretend all notes were modified long before the last run
+    col.db.execute('update notes set mod = 0')
+    index = unidir.UnidirIndex.get(col)
+    index.mods = {src: 0 for src in index.mods}
+    index.scanned = {nid: 0 for nid in index.scanned}
+    index.written = {nid: 0 for nid in index.written}
+
+    spy = RenderSpy(monkeypatch)
+    assert unidir.sync_all(col) == 0
+    assert spy.calls == []
+
+    n1['Text'] = '{{c1::two}}'
+    col.update_note(n1)
+    assert unidir.sync_all(col) == 2
+    assert spy.calls == [(n2.id, 0), (n3.id, 0)]
+    load_notes((n2, n3))
+    assert '<div>two</div>' in n3['Front']
+
+
+def test_sync_all_long_cycle(col):
+    basic = col.models.by_name('Basic')
+
+    notes = [col.new_note(basic) for _ in range(3)]
+    for note in notes:
+        col.add_note(note, 0)
+    for i, note in enumerate(notes):
+        note['Front'] = f'<span class="sync" note="{notes[(i + 1) % 3].id}"></span>'
+    col.update_notes(notes)
+
+    assert unidir.sync_all(col) == 3
+    load_notes(notes)
+    for i, note in enumerate(notes):
+        assert note['Front'] == f'<span class="sync" note="{notes[(i + 1) % 3].id}"><div>Cycle detected</div></span>'
+
+
+def test_render_cache(col, monkeypatch):
+    basic = col.models.by_name('Basic')
+    cloze = col.models.by_name('Cloze')
+
+    n1 = col.new_note(cloze)
+    n1['Text'] = '{{c1::one}}'
+    col.add_note(n1, 0)
+
+    notes = []
+    for _ in range(3):
+        note = col.new_note(basic)
+        note['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+        col.add_note(note, 0)
+        notes.append(note)
+
+    calls = []
+    render_source = unidir.render_source
+
+    def spy(fields, template):
+        calls.append(fields['Text'])
+        return render_source(fields, template)
+    monkeypatch.setattr(unidir, 'render_source', spy)
+
+    assert unidir.sync_all(col) == 3
+    assert calls == ['{{c1::one}}']
+
+    # Shared with the editor
+    notes[0]['Front'] = f'<span class="sync" note="{n1.id}"></span>'
+    assert unidir.sync_field(col, notes[0], 0) is True
+    assert calls == ['{{c1::one}}']
+
+    # Changes within the same second are not missed
+    n1['Text'] = '{{c1::two}}'
+    col.db.execute('update notes set flds = ? where id = ?', n1.joined_fields(), n1.id)
+    assert unidir.sync_field(col, notes[1], 0) is True
+    assert calls == ['{{c1::one}}', '{{c1::two}}']
+    load_notes(notes)
+    assert notes[1]['Front'] == f'<span class="sync" note="{n1.id}">\n<div>two</div>\n</span>'
+
+
+def test_render_cache_size():
+    cache = unidir.RenderCache(max_size=2)
+    template = unidir.Fetcher.compile(unidir.Fetcher.tokenize('{{Front}}'))
+    for src in range(3):
+        assert cache.get(src, ('Basic', {'Front': str(src)}, 0), template) == (f'\n{src}', frozenset())
+    assert [key[0] for key in cache.entries] == [1, 2]
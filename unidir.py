@@ -15,17 +15,39 @@
 
 import os
 import re
-import warnings
-from copy import copy
-from typing import NamedTuple
+import sys
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import TYPE_CHECKING, Any, Callable, Container, Iterable, Iterator, Mapping, NamedTuple, Sequence
 
 import anki.errors
-from anki.collection import Collection
+from anki.collection import Collection, OpChangesWithCount
 from anki.notes import Note
-from aqt import mw
-from bs4 import BeautifulSoup, MarkupResemblesLocatorWarning
+from anki.utils import ids2str
 
-warnings.filterwarnings('ignore', category=MarkupResemblesLocatorWarning)
+from .documents import Documents
+from .graph import strongly_connected
+from .instrument import count, phase
+from .index import NoteIndex
+from .spans import Span, balance, has_sync_spans, parse
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+UNDO_SYNC_ALL = 'Notesync: Refresh all'
+
+# Called with (notes done, notes total), returns False to cancel
+Progress = Callable[[int, int], bool]
+PROGRESS_INTERVAL = 0.1
+
+# Notes are rendered in worker processes only when there are enough of them to pay for starting the workers
+PARALLEL_MIN_NOTES = 500
+CHUNK_SIZE = 50
+
+
+class Cancelled(Exception):
+    pass
 
 
 def _show_synced_notes():
@@ -34,6 +56,60 @@ def _show_synced_notes():
     pass
 
 
+class TemplateRegistry():
+    '''
+    Compiled templates of note types, missing ones included.
+    A template file is checked for changes at most once every CHECK_INTERVAL seconds.
+    '''
+    DIRECTORY = os.path.join(os.path.dirname(__file__), 'user_files', 'templates')
+    CHECK_INTERVAL = 2.0
+
+    class Entry(NamedTuple):
+        checked: float
+        signature: tuple[int, int] | None
+        template: tuple | None
+
+    def __init__(self, directory: str = DIRECTORY):
+        self.directory = directory
+        self.entries: dict[str, TemplateRegistry.Entry] = {}
+
+    def __signature(self, path: str) -> tuple[int, int] | None:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def get(self, notetype: str) -> tuple | None:
+        now = time.monotonic()
+        entry = self.entries.get(notetype)
+        if entry is not None and now - entry.checked < self.CHECK_INTERVAL:
+            return entry.template
+
+        path = os.path.join(self.directory, f'{notetype}.html')
+        signature = self.__signature(path)
+        if entry is not None and entry.signature == signature:
+            self.entries[notetype] = entry._replace(checked=now)
+            return entry.template
+
+        template = None
+        if signature is not None:
+            try:
+                with open(path, 'r') as f:
+                    template = Fetcher.compile(Fetcher.tokenize(f.read()))
+            except IOError:
+                signature = None
+        self.entries[notetype] = TemplateRegistry.Entry(now, signature, template)
+        return template
+
+    def signature(self, notetype: str) -> tuple[int, int] | None:
+        '''
+        Return the signature of the template file as of the last get, None if there is no file.
+        '''
+        self.get(notetype)
+        return self.entries[notetype].signature
+
+
 class Fetcher():
     TOKENS = [
         ('STARTIF', r'{{#.*?}}'),
@@ -48,67 +124,30 @@ class Fetcher():
     RE_ASSUMPTION_HINT = re.compile(r'\[\[(.*?)(::.+?)?\]\]')
     RE_EQ_IM_HINT = re.compile(r'(.*?)(::.*)?', re.DOTALL)
 
-    template_cache = {}
+    # TODO: nested clozes (add rust function)
+    TRANSFORMS = {
+        'FIELD_NORMAL': None,
+        'FIELD_CLOZE': partial(RE_CLOZE.sub, r'\1'),
+        'FIELD_CLOZE_OVERLAPPING': partial(RE_CLOZE_OVERLAPPER.sub, r'\1'),
+        'FIELD_ASSUMPTIONS': partial(RE_ASSUMPTION_HINT.sub, r'\1'),
+        'FIELD_IM_EQ_HINT': partial(RE_EQ_IM_HINT.sub, r'\1'),
+    }
+
+    OP_TEXT = 0
+    OP_FIELD = 1
+    OP_IF = 2
+    OP_ENDIF = 3
+
+    templates = TemplateRegistry()
 
     def __init__(self, this_note: Note, other_note: Note):
         self.this_note = this_note
         self.other_note = other_note
         self.other_notetype = self.other_note.note_type()['name']
-        try:
-            if self.other_notetype not in self.template_cache:
-                with open(os.path.join(os.path.dirname(__file__),
-                                       f'./user_files/templates/{self.other_notetype}.html'), 'r') as f:
-                    self.template_cache[self.other_notetype] = self.tokenize(f.read())
-        except IOError:
+        self.template = self.templates.get(self.other_notetype)
+        if self.template is None:
             raise ValueError('Unknown model')
 
-    @classmethod
-    def __strip_cloze(cls, text: str):
-        # TODO: nested clozes (add rust function)
-        return Fetcher.RE_CLOZE.sub(r'\1', text)
-
-    @classmethod
-    def __strip_cloze_overlapping(cls, text: str):
-        # TODO: nested clozes
-        return Fetcher.RE_CLOZE_OVERLAPPER.sub(r'\1', text)
-
-    @classmethod
-    def __strip_assumption_hints(cls, text: str):
-        return Fetcher.RE_ASSUMPTION_HINT.sub(r'\1', text)
-
-    @classmethod
-    def __strip_im_eq_hints(cls, text: str):
-        return Fetcher.RE_EQ_IM_HINT.sub(r'\1', text)
-
-    def __check_cycles(self, text_other: str):
-        bs = BeautifulSoup(text_other, 'html.parser')
-        spans = bs.find_all('span', {'class': 'sync', 'note': True}, recursive=False)
-        for span in spans:
-            other_id = span.get('note')
-            if other_id == str(self.this_note.id):
-                raise ValueError('Cycle detected')
-        return text_other
-
-    def __fetch_field(self, field: str):
-        text = self.other_note[field]
-        return self.__check_cycles(text)
-
-    def __fetch_cloze_field(self, field: str):
-        text = self.__strip_cloze(self.other_note[field])
-        return self.__check_cycles(text)
-
-    def __fetch_cloze_overlapping_field(self, field: str):
-        text = self.__strip_cloze_overlapping(self.other_note[field])
-        return self.__check_cycles(text)
-
-    def __fetch_assumptions_field(self, field: str):
-        text = self.__strip_assumption_hints(self.other_note[field])
-        return self.__check_cycles(text)
-
-    def __fetch_im_eq_hint_field(self, field: str):
-        text = self.__strip_im_eq_hints(self.other_note[field])
-        return self.__check_cycles(text)
-
     class Token(NamedTuple):
         type: str
         value: str
@@ -151,35 +190,170 @@ class Fetcher():
 
         return tokens
 
-    def fetch(self):
-        out = '\n'
-        skip = ''
-        for token in self.template_cache[self.other_notetype]:
-            if skip != '' and (token.type != 'ENDIF' or token.value != skip):
+    @classmethod
+    def compile(cls, tokens: Sequence['Fetcher.Token']) -> tuple[tuple[int, str, Any], ...]:
+        '''
+        Turn tokens into (opcode, value, argument) instructions. The argument is the transform of
+        a field or the index of the instruction to jump to when the condition of an if is not met.
+        '''
+        ops = []
+        for i, token in enumerate(tokens):
+            if token.type == 'TEXT':
+                ops.append((cls.OP_TEXT, token.value, None))
+            elif token.type == 'STARTIF':
+                # Content is skipped up to the first matching end, wherever it is
+                end = next((j for j in range(i + 1, len(tokens))
+                            if tokens[j].type == 'ENDIF' and tokens[j].value == token.value), len(tokens))
+                ops.append((cls.OP_IF, token.value, end))
+            elif token.type == 'ENDIF':
+                ops.append((cls.OP_ENDIF, token.value, None))
+            else:
+                ops.append((cls.OP_FIELD, token.value, cls.TRANSFORMS[token.type]))
+        return tuple(ops)
+
+    def fetch(self) -> str:
+        return render(self.this_note.id, self.other_note, self.template)
+
+
+def render_source(fields: Mapping[str, str], template: tuple) -> tuple[str, tuple[str, ...], frozenset[str]]:
+    '''
+    Fill the compiled template with fields of the source note.
+    Return the text, names of the fields read and ids of the notes their sync spans reference.
+    '''
+    out = ['\n']
+    read = set()
+    i = 0
+    while i < len(template):
+        op, value, arg = template[i]
+        if op == Fetcher.OP_TEXT:
+            out.append(value)
+        elif op == Fetcher.OP_FIELD:
+            read.add(value)
+            out.append(arg(fields[value]) if arg is not None else fields[value])
+        elif op == Fetcher.OP_IF:
+            read.add(value)
+            if fields[value] == '':
+                i = arg
                 continue
+        i += 1
+
+    refs = frozenset(span.get('note') for field in read for span in parse(fields[field]).find(note=True))
+    # Stray end tags of the source must not close the span the text is placed in
+    return balance(''.join(out)), tuple(sorted(read)), refs
+
+
+def render(this_id: int, fields: Mapping[str, str], template: tuple) -> str:
+    text, _, refs = render_source(fields, template)
+    if str(this_id) in refs:
+        raise ValueError('Cycle detected')
+    return text
+
+
+# Note type name, fields and mod of a source note, plain data which can be sent to other processes
+Source = tuple[str, dict[str, str], int]
+
+
+def to_source(note: Note) -> Source:
+    return (note.note_type()['name'], dict(note.items()), note.mod)
+
+
+class RenderCache():
+    '''
+    Rendered source notes shared by all sync operations, the least recently used are dropped first.
+    Entries are keyed by (source id, source mod, template) and checked against the fields that
+    were read, as mod has a resolution of one second and sync_all renders sources in place.
+    '''
+    MAX_SIZE = 1024
+
+    class Entry(NamedTuple):
+        read: tuple[str, ...]
+        values: tuple[str | None, ...]
+        text: str
+        refs: frozenset[str]
+
+    def __init__(self, max_size: int = MAX_SIZE):
+        self.max_size = max_size
+        self.entries: OrderedDict[tuple[int, int, tuple], RenderCache.Entry] = OrderedDict()
+
+    def get(self, src_id: int, source: Source, template: tuple) -> tuple[str, frozenset[str]]:
+        notetype, fields, mod = source
+        key = (src_id, mod, template)
+        entry = self.entries.get(key)
+        if entry is not None and tuple(fields.get(field) for field in entry.read) == entry.values:
+            self.entries.move_to_end(key)
+            count('render.cached', notetype)
+            return entry.text, entry.refs
+
+        with phase('render', notetype):
+            text, read, refs = render_source(fields, template)
+        self.entries[key] = RenderCache.Entry(read, tuple(fields[field] for field in read), text, refs)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return text, refs
+
+    def clear(self):
+        self.entries.clear()
+
+
+render_cache = RenderCache()
+
+
+def render_span(this_id: int, other_id: str, sources: Mapping[int, Source],
+                templates: Mapping[str, tuple | None], cycles: Container[int] = ()) -> str:
+    try:
+        source = sources.get(int(other_id))
+    except ValueError:
+        source = None
+    if source is not None and int(other_id) in cycles:
+        return '<div>Cycle detected</div>'
+    if source is None:
+        return '<div>Invalid note ID</div>'
+    template = templates.get(source[0])
+    if template is None:
+        return '<div>Unknown model</div>'
+    text, refs = render_cache.get(int(other_id), source, template)
+    if str(this_id) in refs:
+        return '<div>Cycle detected</div>'
+    return text
+
+
+def render_note(this_id: int, fields: dict[int, str], sources: Mapping[int, Source],
+                templates: Mapping[str, tuple | None], cycles: Mapping[int, Container[int]] | None = None,
+                ) -> dict[int, str]:
+    '''
+    Re-render sync spans of the given fields. Return only the fields which changed.
+    Spans of a field referencing one of its cycles (field_idx -> source ids) render an error.
+    '''
+    out = {}
+    for field_idx, field in fields.items():
+        doc = parse(field)
+        changed = False
+        for span in doc.find(note=True):
+            if span.get('note') is None:
+                continue
+            inner = render_span(this_id, span.get('note'), sources, templates,
+                                (cycles or {}).get(field_idx, ()))
+            if span.inner != inner:
+                doc.set_inner(span, inner)
+                changed = True
+        if changed:
+            out[field_idx] = doc.encode()
+    return out
 
-            if token.type == 'STARTIF':
-                if self.__fetch_field(token.value) == '':
-                    skip = token.value
-            elif token.type == 'ENDIF':
-                skip = ''
-            elif token.type == 'FIELD_NORMAL':
-                out += self.__fetch_field(token.value)
-            elif token.type == 'FIELD_CLOZE':
-                out += self.__fetch_cloze_field(token.value)
-            elif token.type == 'FIELD_CLOZE_OVERLAPPING':
-                out += self.__fetch_cloze_overlapping_field(token.value)
-            elif token.type == 'FIELD_ASSUMPTIONS':
-                out += self.__fetch_assumptions_field(token.value)
-            elif token.type == 'FIELD_IM_EQ_HINT':
-                out += self.__fetch_im_eq_hint_field(token.value)
-            elif token.type == 'TEXT':
-                out += token.value
-
-        return BeautifulSoup(out, 'html.parser')
-
-
-def sync_field(col: Collection, this_note: Note, field_idx: int) -> bool:
+
+# nid, field_idx -> field, field_idx -> ids of sources the field is in a cycle with
+Job = tuple[int, dict[int, str], dict[int, set[int]]]
+
+
+def render_chunk(jobs: list[Job], sources: dict[int, Source],
+                 templates: dict[str, tuple | None]) -> list[tuple[int, dict[int, str]]]:
+    # Runs in a worker process, must not touch the collection
+    return [(nid, render_note(nid, fields, sources, templates, cycles)) for nid, fields, cycles in jobs]
+
+
+def sync_field(col: Collection, this_note: Note, field_idx: int, docs: Documents | None = None,
+               only: Callable[[Span], bool] | None = None) -> bool:
     # - find span with class 'sync' with 'note' attribute
     # - fetch optional 'fields' attribute (can contain special fields: text)
     # - or use defaults depending on the target note type)
@@ -195,55 +369,342 @@ def sync_field(col: Collection, this_note: Note, field_idx: int) -> bool:
         return False  # the card is being created
     if field_idx < 0 or field_idx >= len(this_note.values()):
         return False  # should not happen
+    if not has_sync_spans(this_note.fields[field_idx]):
+        return False
+    if docs is None:
+        docs = Documents()
+        changed = sync_field(col, this_note, field_idx, docs, only)
+        docs.flush(col)
+        return changed
+
+    doc = docs.get(this_note, field_idx)
+
+    # top-level spans only: transitive references are not propagated
+    spans = [span for span in doc.find(note=True) if only is None or only(span)]
+    sources = {}
+    for span in spans:
+        try:
+            other_id = int(span.get('note') or '')
+            sources[other_id] = to_source(docs.note(col, other_id))
+        except (ValueError, anki.errors.NotFoundError):
+            pass
+    templates = {source[0]: Fetcher.templates.get(source[0]) for source in sources.values()}
 
     changed = False
-    bs = BeautifulSoup(this_note.values()[field_idx], 'html.parser')
-
-    # recursive=False: transitive references are not propagated (only top spans are synced)
-    spans = bs.find_all('span', {'class': 'sync', 'note': True}, recursive=False)
     for span in spans:
-        other_id = span.get('note')
-        if other_id is None:
+        if span.get('note') is None:
             continue
-
-        span_new = copy(span)
-        span_new.clear()
-        try:
-            other_note = col.get_note(int(other_id))
-            # other_fields = span.get('fields')
-            bs_new = Fetcher(this_note, other_note).fetch()
-            span_new.append(bs_new)
-        except (ValueError, anki.errors.NotFoundError) as e:
-            div = bs.new_tag('div')
-            if str(e) in {'Unknown model', 'Cycle detected'}:
-                div.string = str(e)
-            else:
-                div.string = 'Invalid note ID'
-            span_new.append(div)
-
-        if span != span_new:
-            span.replace_with(span_new)
+        inner = render_span(this_note.id, span.get('note'), sources, templates)
+        if span.inner != inner:
+            doc.set_inner(span, inner)
             changed = True
 
     if changed:
-        this_note.values()[field_idx] = bs.encode(formatter='html5').decode('utf-8')
-        col.update_note(this_note)
+        docs.mark_changed(this_note, field_idx)
     return changed
 
 
-def sync_note(col: Collection, note: Note) -> bool:
+def sync_note(col: Collection, note: Note, field_idxs: Iterable[int] | None = None,
+              docs: Documents | None = None) -> bool:
+    if field_idxs is None:
+        field_idxs = range(len(note.fields))
+    if docs is None:
+        docs = Documents()
+        changed = sync_note(col, note, field_idxs, docs)
+        docs.flush(col)
+        return changed
+
     changed = False
-    for field in note.keys():
-        changed |= sync_field(col, note, note._field_index(field))
+    for field_idx in field_idxs:
+        changed |= sync_field(col, note, field_idx, docs)
     return changed
 
 
-def sync_all() -> int:
-    n_changed = 0
-    ids = mw.col.find_notes('<span class=\\"sync\\" note=')
-    for note_id in ids:
-        note = mw.col.get_note(note_id)
-        changed = sync_note(mw.col, note)
-        if changed:
-            n_changed += 1
-    return n_changed
+def note_references(field: str) -> list[int] | None:
+    spans = parse(field).find(note=True)
+    if len(spans) == 0:
+        return None
+    refs = []
+    for span in spans:
+        try:
+            refs.append(int(span.get('note')))
+        except ValueError:
+            pass
+    return refs
+
+
+class UnidirIndex(NoteIndex):
+    '''
+    Reverse index from a source note to the notes and fields referencing it.
+    '''
+    NAME = 'unidir'
+    VERSION = 4
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        # source nid -> nid -> field indices
+        self.dependents: dict[int, dict[int, set[int]]] = {}
+        # source nid -> mod of the source when its dependents were last rendered
+        self.mods: dict[int, int] = {}
+        # nid -> mod of notes saved by the last run
+        self.written: dict[int, int] = {}
+        # note type -> signature of its template when its sources were last rendered
+        self.templates: dict[str, tuple[int, int] | None] = {}
+
+    def dump(self) -> dict:
+        return {'mods': self.mods, 'written': self.written, 'templates': self.templates}
+
+    def restore(self, data: dict):
+        self.mods = {int(src): mod for src, mod in data['mods'].items()}
+        self.written = {int(nid): mod for nid, mod in data['written'].items()}
+        self.templates = {name: tuple(sig) if sig is not None else None for name, sig in data['templates'].items()}
+
+    def scan_field(self, field: str) -> list[int] | None:
+        return note_references(field)
+
+    def link(self, nid: int, field_idx: int, srcs: list[int]):
+        for src in srcs:
+            self.dependents.setdefault(src, {}).setdefault(nid, set()).add(field_idx)
+
+    def unlink(self, nid: int, field_idx: int, srcs: list[int]):
+        for src in srcs:
+            dependents = self.dependents.get(src)
+            if dependents is None or nid not in dependents:
+                continue
+            dependents[nid].discard(field_idx)
+            if len(dependents[nid]) == 0:
+                del dependents[nid]
+            if len(dependents) == 0:
+                del self.dependents[src]
+
+
+def _pool() -> 'ProcessPoolExecutor | None':
+    # Inside Anki rendering stays in-process, which is the only supported path there: forking the
+    # multi-threaded Qt process may deadlock the workers, spawned ones would import the whole
+    # application again and frozen builds cannot start a bare interpreter. Headless runs
+    # (cli.py, bench.py) spawn fresh interpreters which import only this module.
+    if 'aqt' in sys.modules or getattr(sys, 'frozen', False):
+        return None
+    workers = os.cpu_count() or 1
+    if workers < 2:
+        return None
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def template_reads(template: tuple | None) -> set[str]:
+    if template is None:
+        return set()
+    return {value for op, value, _ in template if op in (Fetcher.OP_FIELD, Fetcher.OP_IF)}
+
+
+Node = tuple[int, int]
+
+
+def _plan(col: Collection, index: UnidirIndex, todo: dict[int, set[int]],
+          ) -> tuple[set[Node], dict[Node, list[Node]], list[list[Node]], dict[Node, set[int]]]:
+    '''
+    Return the fields to render with their dependencies, grouped into levels which can be rendered
+    one after another, and the sources each field is in a cycle with.
+    '''
+    # Graph of (nid, field_idx) nodes. A field depends on the fields of its sources read by their templates.
+    mids = dict(col.db.execute(f'select id, mid from notes where id in {ids2str(index.notes)}'))
+    reads: dict[int, set[int]] = {}
+
+    def read_idxs(nid: int) -> set[int]:
+        mid = mids[nid]
+        if mid not in reads:
+            model = col.models.get(mid)
+            names = template_reads(Fetcher.templates.get(model['name'])) if model is not None else set()
+            reads[mid] = {ord for name, (ord, _) in col.models.field_map(model).items() if name in names} \
+                if model is not None else set()
+        return reads[mid]
+
+    # Everything showing a field in todo has to be rendered after it
+    closure = set()
+    stack = [(nid, field_idx) for nid, field_idxs in todo.items() for field_idx in field_idxs]
+    while len(stack) > 0:
+        node = stack.pop()
+        if node in closure:
+            continue
+        closure.add(node)
+        nid, field_idx = node
+        if field_idx in read_idxs(nid):
+            stack.extend((dependent, idx) for dependent, idxs in index.dependents.get(nid, {}).items() for idx in idxs)
+
+    deps: dict[Node, list[Node]] = {}
+    for nid, field_idx in closure:
+        deps[(nid, field_idx)] = [(src, idx) for src in index.notes[nid][field_idx] if src in index.notes
+                                  for idx in read_idxs(src) & index.notes[src].keys() if (src, idx) in closure]
+
+    # Components come after their dependencies, a level can be rendered once all lower levels are done
+    levels: list[list[Node]] = []
+    level_of: dict[Node, int] = {}
+    cycles: dict[Node, set[int]] = {}
+    for component in strongly_connected(sorted(closure), deps.__getitem__):
+        members = set(component)
+        level = max((level_of[dep] + 1 for node in component for dep in deps[node] if dep not in members), default=0)
+        for node in component:
+            level_of[node] = level
+            in_cycle = {src for src, idx in deps[node] if (src, idx) in members}
+            if len(in_cycle) > 0:
+                cycles[node] = in_cycle
+        if level == len(levels):
+            levels.append([])
+        levels[level].extend(component)
+
+    return closure, deps, levels, cycles
+
+
+def _render_all(col: Collection, index: UnidirIndex, todo: dict[int, set[int]],
+                progress: Progress | None) -> Documents:
+    '''
+    Render the fields in todo and, transitively, all fields showing them. Fields are rendered in
+    topological order from the already rendered versions of their sources, each at most once,
+    so a single pass is enough. References forming a cycle of any length render an error.
+    Rendering runs in worker processes when there is enough work.
+    '''
+    with phase('sync_all.plan'):
+        closure, deps, levels, cycles = _plan(col, index, todo)
+
+    # Load all notes taking part with a single query
+    docs = Documents()
+    docs.preload(col, {nid for nid, _ in closure} | {src for nid, idx in closure for src in index.notes[nid][idx]})
+    sources: dict[int, Source] = {}
+    for nid, field_idx in closure:
+        for src in index.notes[nid][field_idx]:
+            if src not in sources and src in docs.notes:
+                sources[src] = to_source(docs.notes[src])
+    templates = {source[0]: Fetcher.templates.get(source[0]) for source in sources.values()}
+
+    def chunk_args(chunk: list[Job]) -> tuple:
+        # Send each worker only the sources and templates its notes need
+        srcs = {src for nid, fields, _ in chunk for idx in fields for src in index.notes[nid][idx]}
+        chunk_sources = {src: sources[src] for src in srcs if src in sources}
+        return chunk, chunk_sources, {source[0]: templates[source[0]] for source in chunk_sources.values()}
+
+    done = 0
+    reported = 0.0
+
+    def report():
+        nonlocal reported
+        if progress is not None and time.monotonic() - reported >= PROGRESS_INTERVAL:
+            reported = time.monotonic()
+            if not progress(done, len(closure)):
+                raise Cancelled()
+
+    def rendered(jobs: list[Job]) -> Iterator[tuple[int, dict[int, str]]]:
+        nonlocal done
+        chunks = [jobs[i:i + CHUNK_SIZE] for i in range(0, len(jobs), CHUNK_SIZE)]
+        if pool is None:
+            futures = None
+            results = ((chunk, render_chunk(*chunk_args(chunk))) for chunk in chunks)
+        else:
+            futures = {pool.submit(render_chunk, *chunk_args(chunk)): chunk for chunk in chunks}
+            from concurrent.futures import as_completed
+            results = ((futures[future], future.result()) for future in as_completed(futures))
+        report()
+        for chunk, result in results:
+            yield from result
+            done += sum(len(fields) for _, fields, _ in chunk)
+            report()
+
+    todo_nodes = {(nid, field_idx) for nid, field_idxs in todo.items() for field_idx in field_idxs}
+    changed = set()
+    pool = _pool() if len(closure) >= PARALLEL_MIN_NOTES else None
+    try:
+        for level in levels:
+            jobs: dict[int, Job] = {}
+            for node in level:
+                nid, field_idx = node
+                note = docs.notes.get(nid)
+                # Fields whose sources did not change are final already
+                if note is None or (node not in todo_nodes and not any(dep in changed for dep in deps[node])):
+                    done += 1
+                    continue
+                job = jobs.setdefault(nid, (nid, {}, {}))
+                job[1][field_idx] = note.fields[field_idx]
+                if node in cycles:
+                    job[2][field_idx] = cycles[node]
+
+            for nid, fields in rendered(list(jobs.values())):
+                note = docs.notes[nid]
+                names = note.keys()
+                for field_idx, field in fields.items():
+                    docs.update(note, field_idx, field)
+                    changed.add((nid, field_idx))
+                    # Dependents in the following levels see the rendered field
+                    if nid in sources:
+                        sources[nid][1][names[field_idx]] = field
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    return docs
+
+
+def sync_all_op(col: Collection, progress: Progress | None = None) -> OpChangesWithCount:
+    '''
+    Re-render spans of notes referencing a note modified since the last run.
+    All changed notes are saved at once under a single undo entry.
+    Raise Cancelled if progress returns False, nothing is saved then.
+    '''
+    index = UnidirIndex.get(col)
+    # State to roll back to on cancel or failure, so that skipped notes are rendered by the next run
+    saved = (index.checkpoint, index.usn, index.mods, index.written, index.templates)
+    try:
+        out = _sync_all(col, index, progress)
+    except BaseException:
+        index.checkpoint, index.usn, index.mods, index.written, index.templates = saved
+        index.save()
+        raise
+    index.save()
+    return out
+
+
+def _sync_all(col: Collection, index: UnidirIndex, progress: Progress | None) -> OpChangesWithCount:
+    dirty = index.refresh(col)
+    # Notes saved by the last run are rendered already unless they were modified since,
+    # an undo of the run puts back their older mod without them being rescanned
+    written = dict(col.db.execute(f'select id, mod from notes where id in {ids2str(index.written)}'))
+    dirty = {nid for nid in dirty if written.get(nid, -1) != index.written.get(nid)}
+    dirty.update(nid for nid, mod in index.written.items() if written.get(nid) != mod)
+
+    # nid -> field indices to re-render
+    todo = {nid: set(index.notes[nid]) for nid in dirty if nid in index.notes}
+
+    srcs = list(index.dependents.keys())
+    mods = {}
+    notetypes = {}
+    for src, mod, mid in col.db.execute(f'select id, mod, mid from notes where id in {ids2str(srcs)}'):
+        mods[src] = mod
+        notetypes[src] = mid
+    names = {mid: (col.models.get(mid) or {}).get('name') for mid in set(notetypes.values())}
+    # Sources of note types whose template file was edited are rendered again
+    signatures = {name: Fetcher.templates.signature(name) for name in names.values() if name is not None}
+    edited = {name for name, signature in signatures.items() if index.templates.get(name) != signature}
+    for src in srcs:
+        if src in dirty or mods.get(src) != index.mods.get(src) or names.get(notetypes.get(src)) in edited:
+            for nid, field_idxs in index.dependents[src].items():
+                todo.setdefault(nid, set()).update(field_idxs)
+    index.mods = {src: mods[src] for src in srcs if src in mods}
+    index.templates = signatures
+
+    with phase('sync_all.render'):
+        docs = _render_all(col, index, todo, progress)
+
+    out = OpChangesWithCount()
+    index.written = {}
+    if len(docs.changed) > 0 or len(docs.updated) > 0:
+        undo_entry = col.add_custom_undo_entry(UNDO_SYNC_ALL)
+        nids = docs.flush(col)
+        out.count = len(nids)
+        out.changes.CopyFrom(col.merge_undo_entries(undo_entry))
+        # Our own writes must not make the next run render the same notes again
+        index.written = dict(col.db.execute(f'select id, mod from notes where id in {ids2str(nids)}'))
+        index.mods.update({nid: mod for nid, mod in index.written.items() if nid in index.mods})
+    return out
+
+
+def sync_all(col: Collection) -> int:
+    return sync_all_op(col).count